@@ -11,7 +11,7 @@ import pandas as pd
 from pygam import LinearGAM
 from scipy.stats import norm
 from joblib import Parallel, delayed
-from mlconfound.stats import partial_confound_test
+from mlconfound.stats import partial_confound_test, _conditional_log_likelihood_factory, _generate_X_CPT_MC, _r2_factory
 from mlconfound.simulate import simulate_y_c_yhat
 
 # NOTE
@@ -93,6 +93,57 @@ def cpt_p_pearson(c, yhat, yt, cond_like_mat=None, mcmc_steps=50, random_state=N
   return p, t_xpi_y
 
 
+def r2_multi(yhats, xs, cat_yhat=False):
+  # R2 of every row of xs [P, n] with every row of yhats [S, n] -> [S, P] as mlconfound computes it for
+  # a numerical x: the squared Pearson correlation for a numerical ŷ, the R2 of ols('x ~ C(ŷ)') (between
+  # class over total sum of squares) for a categorical ŷ
+  xs = xs - xs.mean(axis=1, keepdims=True)
+  ss_total = np.sum(xs**2, axis=1)                                                # [P]
+  if cat_yhat:
+    onehot = (yhats[:,np.newaxis,:] == np.unique(yhats)[np.newaxis,:,np.newaxis]).astype(float)  # [S, K, n]
+    n_k = onehot.sum(axis=2, keepdims=True)
+    sums = onehot @ xs.T                                                          # [S, K, P]
+    ss_between = np.sum(np.divide(sums**2, n_k, out=np.zeros_like(sums), where=n_k > 0), axis=1)
+  else:
+    yz = yhats - yhats.mean(axis=1, keepdims=True)
+    ss_y = np.sum(yz**2, axis=1, keepdims=True)
+    ss_between = np.divide((yz @ xs.T)**2, ss_y, out=np.zeros((len(yz), len(xs))), where=ss_y > 0)
+  return np.divide(ss_between, ss_total, out=np.zeros_like(ss_between), where=ss_total > 0)
+
+def cpt_p_multi(y, yhats, c, num_perms=1000, cat_y=False, cat_yhat=False, cat_c=False, mcmc_steps=50,
+                cond_dist_method="gam", random_state=None, n_jobs=-1):
+  # mlconfound's partial_confound_test (H0: C ⟂ Ŷ|Y, same arguments) for many predictions of the same target
+  # at once, e.g. all the solutions on a Pareto front. The density q(c|y) and the sampled permutations of c
+  # only depend on c and y, so they are computed once, with mlconfound's own density estimate and sampler
+  # seeded the same way, and shared by every row of yhats [S, n]. The statistic R2(c, ŷ) is the one of
+  # mlconfound, vectorized over the rows and permutations for a numerical c (see r2_multi) and computed per
+  # pair with mlconfound's for a categorical c. With n_jobs=1 the p values equal partial_confound_test's.
+  x = np.array(c)
+  yhats = np.atleast_2d(np.asarray(yhats))
+  rng = np.random.default_rng(random_state)
+  random_states = rng.integers(np.iinfo(np.int32).max, size=num_perms)
+
+  # 1. density estimation
+  cond_log_lik_mat = _conditional_log_likelihood_factory(cat_c, cat_y, cond_dist_method)(x, y)
+
+  # 2. permutation sampling, once for all the predictions
+  Pi_init = _generate_X_CPT_MC(mcmc_steps*5, cond_log_lik_mat, np.arange(len(x), dtype=int), random_state=random_state)
+  def workhorse(_random_state):
+    Pi = _generate_X_CPT_MC(mcmc_steps, cond_log_lik_mat, Pi_init, random_state=_random_state)
+    return x[Pi]
+  x_perm = np.array(Parallel(n_jobs=n_jobs)(delayed(workhorse)(i) for i in random_states))
+
+  # 3. p-value calculation
+  if cat_c:
+    r2_c_yhat = _r2_factory(cat_c, cat_yhat)
+    t_x_y   = np.array([r2_c_yhat(x, yhat) for yhat in yhats])
+    t_xpi_y = np.array([[r2_c_yhat(xp, yhat) for xp in x_perm] for yhat in yhats])
+  else:
+    t_x_y   = r2_multi(yhats, x[np.newaxis,:].astype(float), cat_yhat)[:,0]         # [S]
+    t_xpi_y = r2_multi(yhats, x_perm.astype(float), cat_yhat)                      # [S, num_perms]
+  p = np.sum(t_xpi_y >= t_x_y[:,np.newaxis], axis=1) / num_perms
+  return p, t_xpi_y
+
 def cpt_p_pearson_torch(x, y, cond_log_like_mat, mcmc_steps=50, num_perm=1000, random_state=None, dtype='numerical'):
   # both x and y has to be torch tensor due to gradient computation, cond_log_like_mat can be provided as a numpy array
 
@@ -185,6 +236,28 @@ def verify_implementation(random_state, num_perm, H1_y, H1_c, H1_yhat):
   assert np.allclose(ret.p, p), "p-value does not match with original implementation"
   # assert np.allclose(ret.null_distribution, t_xpi_y), "null distribution does not match with original implementation"
 
+def verify_multi(random_state, num_perm, H1_y, H1_c, H1_yhats, cat_yhat=True):
+  # batched test against the original implementation, one call per prediction, both on one job so that
+  # the permutations are sampled in the same order
+  p, _ = cpt_p_multi(H1_y, H1_yhats, H1_c, num_perms=num_perm, cat_y=True, cat_yhat=cat_yhat, cat_c=False,
+                     random_state=random_state, n_jobs=1)
+  p_orig = [partial_confound_test(H1_y, yhat, H1_c, num_perms=num_perm, cat_y=True, cat_yhat=cat_yhat, cat_c=False,
+                                  random_state=random_state, progress=False, n_jobs=1).p for yhat in H1_yhats]
+
+  print(f"original implementation p-values: {p_orig}")
+  print(f"batched implementation  p-values: {list(p)}")
+
+  assert np.allclose(p_orig, p), "p-values do not match with original implementation"
+
+def multi_examples(H1_y, H1_yhat, noise=(0, 0.5, 1), random_state=42):
+  # binary target and binary, 3-class and continuous predictions with increasing noise for verify_multi
+  rng = np.random.default_rng(random_state)
+  Y_cat = (H1_y > np.median(H1_y)).astype(int)
+  noisy = np.array([H1_yhat + rng.normal(scale=s, size=len(H1_yhat)) for s in noise])
+  return Y_cat, {"binary"     : (noisy > np.median(H1_yhat)).astype(int),
+                 "3-class"    : np.digitize(noisy, np.quantile(H1_yhat, [1/3, 2/3])),
+                 "continuous" : noisy}
+
 def verify_np_vs_torch(random_state, num_perm, H1_y, H1_c, H1_yhat):
   # original function
   ret = partial_confound_test(H1_y, H1_yhat, H1_c, num_perms=num_perm, return_null_dist=True, random_state=random_state, n_jobs=-1)
@@ -209,8 +282,17 @@ if __name__ == "__main__":
   verify_implementation(num_perm=500,  random_state=130, H1_y=H1_y, H1_c=H1_c, H1_yhat=H1_yhat)
   verify_implementation(num_perm=1000, random_state=421, H1_y=H1_y, H1_c=H1_c, H1_yhat=H1_yhat)
 
+  # verify the batched multi-target test vs. the original implementation, on a binary target and
+  # binary (as in the GA post-evaluation), 3-class and continuous predictions of increasing noise
+  print("2. compare the batched implementation with the original implementation")
+  Y_cat, Yhats = multi_examples(H1_y, H1_yhat)
+  for name, cat_yhat in (("binary", True), ("3-class", True), ("continuous", False)):
+    print(name)
+    verify_multi(num_perm=50,  random_state=5,  H1_y=Y_cat, H1_c=H1_c, H1_yhats=Yhats[name], cat_yhat=cat_yhat)
+    verify_multi(num_perm=100, random_state=30, H1_y=Y_cat, H1_c=H1_c, H1_yhats=Yhats[name], cat_yhat=cat_yhat)
+
   # verify the numpy implementation vs. the torch implementation
-  print("2. compare with re-implementation in torch")
+  print("3. compare with re-implementation in torch")
   cond_like_mat = conditional_log_likelihood(X=H1_c, C=H1_y, xdtype='numerical')
 
   p, _ = cpt_p_pearson(c=H1_c, yhat=H1_yhat, yt=H1_y, cond_like_mat=cond_like_mat, random_state=42)
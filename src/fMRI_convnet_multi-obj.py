@@ -1,17 +1,19 @@
-import os, math, wandb, argparse, requests, torch
+import os, wandb, argparse, requests, torch
 import numpy as np
 import pandas as pd
-import nibabel as nib
 import torch.optim as optim
 import torch.nn.functional as F
 from copy import deepcopy
 from torch import nn, optim
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from torchinfo import summary
 from mlconfound.stats import partial_confound_test
-from tqdm import tqdm, trange
+from tqdm import trange
 from sklearn.model_selection import train_test_split
-from util.fMRIImageLoader import num2vect, CenterRandomShift, RandomMirror
+from util.fMRIImageLoader import IXIDataset, CenterRandomShift, open_volume_store, PrefetchSampler
+from util.torchhelpers import Runtime, ModelSnapshot, compile_model
+from util.fMRIImageLoader import BatchCenterRandomShift, BatchRandomMirror
+from util.metrics import MetricSums
 from multiprocessing.pool import ThreadPool
 from pymoo.optimize import minimize
 from pymoo.operators.mutation.pm import PM
@@ -24,6 +26,9 @@ from pymoo.core.problem import ElementwiseProblem
 
 DATA_DIR   = os.getenv("DATA_DIR",   "data/IXI_4x4x4")
 DATA_SPLIT = os.getenv("DATA_SPLIT", "all")
+DATA_STORE = os.getenv("DATA_STORE", None)
+DATA_DTYPE = os.getenv("DATA_DTYPE", "float32")
+MAX_SHIFT  = 2
 
 def generate_wandb_name(config):
   train_sites = '_'.join(sorted(config['site_train']))
@@ -44,68 +49,6 @@ def load_and_split_data(config):
 
   return df_train, df_val, df_test
 
-class IXIDataset(Dataset):
-  def __init__(self, data_dir, data_df, bin_range=None, transform=None):
-    self.directory = data_dir
-    self.info = data_df
-    self.info = self.info.reset_index(drop=True)
-    self.transform = transform
-
-    if not bin_range:
-      self.bin_range = [math.floor(self.info['AGE'].min()), math.ceil(self.info['AGE'].max())]
-      print(f"Age min {self.info['AGE'].min()}, Age max {self.info['AGE'].max()}")
-      print("Computed Bin Range: ", self.bin_range)
-    else:
-      self.bin_range  = bin_range
-      print(f"Provided Bin Range: {self.bin_range}")
-
-    # Count the number of images from each site
-    site_counts = self.info['SITE'].value_counts()
-    print("Count of entries by SITE:")
-    print(site_counts)
-
-    total_count = site_counts.sum()
-    print(f"\nTotal count for selected sites: {total_count}")
-
-    # Pre-load the images and labels (if RAM is allowing)
-    print(self.info["FILENAME"][0])
-    nii = nib.load(self.directory+"/"+self.info["FILENAME"][0])
-    voxel_size = nii.header.get_zooms()
-    print(f"Voxel Size: {voxel_size}")
-    image = torch.tensor(nii.get_fdata(), dtype=torch.float32)
-    self.image_all = torch.empty((len(self.info),) + tuple(image.shape), dtype=torch.float32)
-
-    age = np.array([71.3])
-    y, bc = num2vect(age, self.bin_range, 1, 1)
-    label = torch.tensor(y, dtype=torch.float32)
-    self.label_all = torch.empty((len(self.info),) + tuple(label.shape)[1:], dtype=torch.float32)
-
-    for i in tqdm(range(len(self.info)), desc="Loading Data"):
-      nii = nib.load(self.directory+"/"+self.info["FILENAME"][i])
-      self.image_all[i,:] = torch.tensor(nii.get_fdata(), dtype=torch.float32)
-
-      age = self.info["AGE"][i]
-      y, _ = num2vect(age, self.bin_range, 1, 1)
-      y += 1e-16
-      self.label_all[i,:] = torch.tensor(y, dtype=torch.float32)
-
-    self.bin_center = torch.tensor(bc, dtype=torch.float32)
-
-    print(f"Image Dim {self.image_all.shape}")
-    print(f"Label Dim {self.label_all.shape}")
-    print(f"Min={self.image_all.min()}, Max={self.image_all.max()}, Mean={self.image_all.mean()}, Std={self.image_all.std()}")
-
-  def __len__(self):
-    return len(self.info)
-
-  def __getitem__(self, idx):
-    image, label = self.image_all[idx,:], self.label_all[idx,:]
-    if self.transform:
-      for tsfrm in self.transform:
-        image = tsfrm(image)
-    image = torch.unsqueeze(image, 0)
-    return image, label
-
 class SFCN(nn.Module):
   def __init__(self, channel_number=[32, 64, 128, 256, 256, 64], output_dim=40, dropout=True):
     super(SFCN, self).__init__()
@@ -159,7 +102,7 @@ class SFCN(nn.Module):
 
   def forward(self, x):
     x = self.feature_extractor(x)
-    x = x.view(x.size(0), -1)
+    x = x.flatten(1)
     x = self.classifier(x)
     x = F.softmax(x, dim=1)
     return x
@@ -169,7 +112,8 @@ class OptimizeMLPLayer(ElementwiseProblem):
     super().__init__(n_var=n_var, n_obj=n_obj, n_constr=n_constr, xl = xl, xu = xu, **kwargs)
 
   def load_data(self, y_train_cpt, c_train, dataloader, clf, bin_center, perm):
-    self.clf = clf.to("cuda")
+    self.clf = clf
+    self.device = next(clf.parameters()).device
     self.bin_center = bin_center
     self.dataloader = dataloader
     self.y_train_cpt = y_train_cpt
@@ -179,7 +123,7 @@ class OptimizeMLPLayer(ElementwiseProblem):
 
   def _evaluate(self, x, out, *args, **kwargs):
     with torch.no_grad():
-      weight = torch.tensor(x.reshape((64,512)), dtype=torch.float, device="cuda")
+      weight = torch.tensor(x.reshape((64,512)), dtype=torch.float, device=self.device)
       clf_copy = deepcopy(self.clf)
       clf_copy.fc_6.weight.data = weight
       output = clf_copy(self.x_train)
@@ -193,7 +137,10 @@ class OptimizeMLPLayer(ElementwiseProblem):
       out['F'] = [kl_div_loss.to("cpu").numpy(), 1-ret.p]
 
 def train(config, run=None):
-  device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+  # SFCN runs its Conv3d in channels_last_3d, bf16 autocast without loss scaling on CPU
+  runtime = Runtime(config["device"], config["precision"], config["threads"], config["interop_threads"], channels_last=True)
+  device = runtime.device
+  print(runtime)
 
   print(config) 
 
@@ -206,26 +153,66 @@ def train(config, run=None):
   # 2) has a probability of 50% to be mirrored about the sagittal plane
   df_train, df_val, df_test = load_and_split_data(config)
 
+  # all the splits read from the same memory-mapped volume store when DATA_STORE is set,
+  # it is ingested once from the NIfTI files in DATA_DIR. DATA_DTYPE (float32, float16 or uint8)
+  # is the precision the volumes are kept in, they are converted back to float32 per sample.
+  # Only the center region read by CenterRandomShift plus the MAX_SHIFT margin is kept, and unless
+  # the volumes are read lazily they are placed once in shared memory for all the splits and workers
+  store = None
+  if DATA_STORE:
+    store = open_volume_store(DATA_STORE, DATA_DIR, pd.read_csv("data/IXI_all.csv")["FILENAME"], dtype=DATA_DTYPE, margin=MAX_SHIFT)
+    if not config["lazy"]:
+      store.share(shared=config["num_workers"] > 0)
+
   data_train = IXIDataset(data_dir=DATA_DIR, data_df=df_train,
                           bin_range=bin_range, 
-                          transform=[CenterRandomShift(randshift=True), RandomMirror()])
+                          transform=None,
+                          store=store, dtype=DATA_DTYPE, margin=MAX_SHIFT,
+                          lazy=config["lazy"], cache_size=config["cache_size"], normalize=config["normalize"],
+                          shared=config["num_workers"] > 0)
+
+  # valid/test are standardized with the intensity statistics of the training split
+  normalize = data_train.stats if config["normalize"] else None
 
   data_valid = IXIDataset(data_dir=DATA_DIR, data_df=df_val,
                           bin_range=bin_range, 
-                          transform=[CenterRandomShift(randshift=False)])
+                          transform=[CenterRandomShift(randshift=False, max_shift=MAX_SHIFT)],
+                          store=store, dtype=DATA_DTYPE, margin=MAX_SHIFT,
+                          lazy=config["lazy"], cache_size=config["cache_size"], normalize=normalize,
+                          shared=config["num_workers"] > 0)
 
   data_test = IXIDataset(data_dir=DATA_DIR, data_df=df_test,  
                          bin_range=bin_range,
-                         transform=[CenterRandomShift(randshift=False)])
+                         transform=[CenterRandomShift(randshift=False, max_shift=MAX_SHIFT)],
+                         store=store, dtype=DATA_DTYPE, margin=MAX_SHIFT,
+                         lazy=config["lazy"], cache_size=config["cache_size"], normalize=normalize,
+                         shared=config["num_workers"] > 0)
 
   bin_center = data_train.bin_center.reshape([-1,1])
 
-  dataloader_train     = DataLoader(data_train, batch_size=config["bs"], num_workers=config["num_workers"], pin_memory=True, shuffle=True)
-  dataloader_train_cpt = DataLoader(data_train, batch_size=config["bs"], num_workers=config["num_workers"], pin_memory=True, shuffle=False)
-  dataloader_valid     = DataLoader(data_valid, batch_size=config["bs"], num_workers=config["num_workers"], pin_memory=True, shuffle=False)
-  dataloader_test      = DataLoader(data_test,  batch_size=config["bs"], num_workers=config["num_workers"], pin_memory=True, shuffle=False)
+  # the training samples are augmented per batch, after collation and on the device
+  augment = nn.Sequential(BatchCenterRandomShift(randshift=True, max_shift=MAX_SHIFT), BatchRandomMirror())
+
+  # in lazy mode without workers the samplers queue the upcoming volumes for the background prefetch
+  # of each dataset, DataLoader workers hold their own copies of the cache that a prefetch in the
+  # main process would never fill
+  def sampler(data, shuffle):
+    base = RandomSampler(data) if shuffle else SequentialSampler(data)
+    if config["lazy"] and config["num_workers"] == 0:
+      return PrefetchSampler(base, data.cache, config["prefetch"])
+    return base
+
+  # the workers are started once and kept for all the epochs, they only hold handles to the
+  # shared volumes
+  loader_args = dict(batch_size=config["bs"], num_workers=config["num_workers"], pin_memory=True,
+                     persistent_workers=config["num_workers"] > 0)
+  dataloader_train     = DataLoader(data_train, sampler=sampler(data_train, True),  **loader_args)
+  dataloader_train_cpt = DataLoader(data_train, sampler=sampler(data_train, False), **loader_args)
+  dataloader_valid     = DataLoader(data_valid, sampler=sampler(data_valid, False), **loader_args)
+  dataloader_test      = DataLoader(data_test,  sampler=sampler(data_test, False),  **loader_args)
   
   x, y = next(iter(dataloader_train))
+  x = augment(x)
   print("\nTraining data summary:")
   print(f"Total data: {len(data_train)}")
   print(f"Input {x.shape}")
@@ -249,33 +236,34 @@ def train(config, run=None):
     with open("run_20190719_00_epoch_best_mae.pth", "wb") as file:
       file.write(response.content)
 
-  w_pretrained = torch.load("run_20190719_00_epoch_best_mae.pth")
+  w_pretrained = torch.load("run_20190719_00_epoch_best_mae.pth", map_location="cpu")
   w_feature_extractor = {k: v for k, v in w_pretrained.items() if "module.classifier" not in k}
   model.load_state_dict(w_feature_extractor, strict=False)
   
   criterion = nn.KLDivLoss(reduction="batchmean", log_target=True)
   optimizer = optim.SGD(model.parameters(), lr=config["lr"], weight_decay=config["wd"])
   scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=config["step_size"], gamma=config["gamma"])
-  scaler = torch.cuda.amp.GradScaler(enabled=True)
+  scaler = runtime.grad_scaler()
   
   # main training loop
   print(criterion)
-  model.to(device)
+  model = runtime.model(model)
+  # the compiled forward shares the parameters of model, which is still the one saved and copied
+  forward = compile_model(model) if config["compile"] else model
   bin_center = bin_center.to(device)
 
   MAE_age_train_best = float('inf')
   MAE_age_valid_best = float('inf')
   MAE_age_test_best = float('inf')
-  model_best = None
+  snapshot = ModelSnapshot(model)
   
   t = trange(config["epochs"], desc="\nTraining", leave=True)
   for epoch in t:
-    loss_train = 0.0
-    MAE_age_train = 0.0
+    metrics = MetricSums()
     for images, labels in dataloader_train:
-      images, labels = images.to(device), labels.to(device)
-      with torch.autocast(device_type="cuda", dtype=torch.float16, enabled=True):
-        output = model(images)
+      images, labels = augment(runtime.inputs(images)), labels.to(device)
+      with runtime.autocast():
+        output = forward(images)
         loss = criterion(output.log(), labels.log())
       scaler.scale(loss).backward()
       scaler.step(optimizer)
@@ -287,40 +275,38 @@ def train(config, run=None):
         age_pred   = output @ bin_center
         MAE_age = F.l1_loss(age_pred, age_target, reduction="mean")
   
-        loss_train += loss.item()
-        MAE_age_train += MAE_age.item()
+        metrics.add(loss=loss, MAE_age=MAE_age)
   
+    loss_train, MAE_age_train = metrics.read("loss", "MAE_age")
     loss_train = loss_train / len(dataloader_train)
     MAE_age_train = MAE_age_train / len(dataloader_train)
   
     with torch.no_grad():
-      loss_valid = 0.0
-      MAE_age_valid = 0.0
+      metrics = MetricSums()
       for images, labels in dataloader_valid:
-        x, y = images.to(device), labels.to(device)
-        output = model(x)
+        x, y = runtime.inputs(images), labels.to(device)
+        output = forward(x)
         loss = criterion(output.log(), y.log())
   
         age_target = y @ bin_center
         age_pred   = output @ bin_center
         MAE_age = F.l1_loss(age_pred, age_target, reduction="mean")
   
-        loss_valid += loss.item()
-        MAE_age_valid += MAE_age.item()
+        metrics.add(loss=loss, MAE_age=MAE_age)
+      loss_valid, MAE_age_valid = metrics.read("loss", "MAE_age")
 
-      loss_test = 0.0
-      MAE_age_test = 0.0
+      metrics = MetricSums()
       for images, labels in dataloader_test:
-        x, y = images.to(device), labels.to(device)
-        output = model(x)
+        x, y = runtime.inputs(images), labels.to(device)
+        output = forward(x)
         loss = criterion(output.log(), y.log())
   
         age_target = y @ bin_center
         age_pred   = output @ bin_center
         MAE_age = F.l1_loss(age_pred, age_target, reduction="mean")
   
-        loss_test += loss.item()
-        MAE_age_test += MAE_age.item()
+        metrics.add(loss=loss, MAE_age=MAE_age)
+      loss_test, MAE_age_test = metrics.read("loss", "MAE_age")
 
     loss_valid = loss_valid / len(dataloader_valid)
     MAE_age_valid = MAE_age_valid / len(dataloader_valid)
@@ -332,7 +318,7 @@ def train(config, run=None):
       MAE_age_train_best = MAE_age_train
       MAE_age_valid_best = MAE_age_valid
       MAE_age_test_best = MAE_age_test
-      model_best = deepcopy(model)
+      snapshot.update(model)
   
     scheduler.step()
   
@@ -346,25 +332,30 @@ def train(config, run=None):
                "test/MAE_age":  MAE_age_test,
                })
 
+  # only the final best is rebuilt into a module
+  model_best = snapshot.module(model)
+
   # Running the initial confounding test   
   with torch.no_grad():
     # Convert the SITE from text to indices
     site_index, _ = pd.factorize(df_train['SITE'])
     C, Y_target, Y_predict = np.array(site_index), [], []
-    MAE_age_temp = 0
+    metrics = MetricSums()
     for images, labels in dataloader_train_cpt:
-      images, labels = images.to(device), labels.to(device)
+      images, labels = augment(runtime.inputs(images)), labels.to(device)
       output = model_best(images)
       age_target = labels @ bin_center
       age_pred   = output @ bin_center
       MAE_age = F.l1_loss(age_pred, age_target, reduction="mean")
-      MAE_age_temp += MAE_age.item()
+      metrics.add(MAE_age=MAE_age)
 
-      Y_target.append(age_target.cpu().numpy())
-      Y_predict.append(age_pred.cpu().numpy())
+      Y_target.append(age_target)
+      Y_predict.append(age_pred)
 
-    Y_target = np.concatenate(Y_target).squeeze()
-    Y_predict = np.concatenate(Y_predict).squeeze()
+    # read back once after the pass
+    MAE_age_temp, = metrics.read("MAE_age")
+    Y_target = torch.cat(Y_target).float().cpu().numpy().squeeze()
+    Y_predict = torch.cat(Y_predict).float().cpu().numpy().squeeze()
 
     print(f"C: {C.shape}")
     print(f"Y_target: {Y_target.shape}")
@@ -430,6 +421,16 @@ if __name__ == "__main__":
   parser = argparse.ArgumentParser(description="Example:")
   parser.add_argument("--bs", type=int,   default=8,    help="batch size")
   parser.add_argument("--num_workers", type=int,   default=2,    help="number of workers")
+  parser.add_argument("--lazy", action="store_true",             help="read the volumes on demand instead of preloading them")
+  parser.add_argument("--cache_size", type=int, default=64,      help="number of decoded volumes cached in lazy mode")
+  parser.add_argument("--prefetch", type=int,   default=8,       help="number of upcoming volumes prefetched in lazy mode with --num_workers 0")
+  parser.add_argument("--normalize", action="store_true",        help="standardize the intensities with the training statistics")
+  parser.add_argument("--device", type=str, default=None,         help="cuda or cpu, cuda when available by default")
+  parser.add_argument("--precision", type=str, default="auto", choices=["auto", "fp32", "fp16", "bf16"],
+                      help="autocast precision, fp16 on cuda and bf16 on cpu for auto")
+  parser.add_argument("--threads", type=int, default=0,           help="intra-op threads, 0 for the torch default")
+  parser.add_argument("--interop_threads", type=int, default=0,   help="inter-op threads, 0 for the torch default")
+  parser.add_argument("--compile", action="store_true",           help="run the model through torch.compile, eager if it fails")
   parser.add_argument("--epochs", type=int,   default=10,   help="total number of epochs")
   parser.add_argument("--lr", type=float, default=1e-2, help="learning rate")
   parser.add_argument("--wd", type=float, default=1e-3, help="weight decay")
@@ -2,7 +2,6 @@ import os
 import wandb
 import argparse
 import numpy as np
-from multiprocessing.pool import ThreadPool
 from mlconfound.stats import partial_confound_test
 from sklearn.svm import SVC
 from sklearn.metrics import accuracy_score
@@ -16,35 +15,72 @@ from pymoo.operators.crossover.sbx import SBX
 from pymoo.operators.sampling.rnd import FloatRandomSampling
 from pymoo.util.display.multi import MultiObjectiveOutput
 
-from util.sEMGhelpers import load_datafile, LoadTrainTestFeatures
+from util.sEMGhelpers import load_feature_cache, partition_feature_cache
+from cpt import cpt_p_multi
+from util.GAhelpers import CoreBudget, FidelitySchedule, ProxyScreen, partial_correlation, refine_front, \
+                          save_checkpoint, load_checkpoint, resume_algorithm
 
 WANDB = os.getenv("WANDB", False)
 NAME  = os.getenv("NAME",  "Confounding-Mitigation-In-Deep-Learning")
 GROUP = os.getenv("GROUP", "SVM-sEMG")
 
+DATA_FILE  = os.getenv("DATA_FILE",  "data/subjects_40_v6.mat")
+DATA_CACHE = os.getenv("DATA_CACHE", "data/subjects_40_v6")
+
 class MyProblem(ElementwiseProblem):
   def __init__(self, **kwargs):
     super().__init__(n_var=48, n_obj=2, n_constr=0,
                      xl = -2*np.ones(48), xu =  2*np.ones(48),
                      **kwargs)
 
-  def load_data_svm(self, x_train, y_train, c_train, clf, permu):
+  def load_data_svm(self, x_train, y_train, c_train, clf, fidelity, budget, screen=None):
     # Load informations from the individual classification exerpiment
     # x_train - training features
     # y_train - labels
     # c_train - confounding variables
     # model   - the trained svm model
+    # fidelity - number of permutations of the CPT for each generation
+    # screen  - optional ProxyScreen to skip the CPT of chromosomes dominated on the proxy
     self.x_train = x_train
     self.y_train = y_train
     self.c_train = c_train
     self.clf     = clf
-    self.permu   = permu
+    self.fidelity = fidelity
+    self.budget  = budget
+    self.screen  = screen
+    self.proxy   = {}
+    # fitness cache keyed by the chromosome bytes, it stores the objectives together with
+    # the number of permutations they were computed with and is saved with the checkpoints
+    self.cache   = {}
+    # generation whose offspring are being evaluated, updated by MyCallback
+    self.generation = 1
 
     # dimension of the training feature
     self.n = np.shape(x_train)[0]
     self.d = np.shape(x_train)[1]
 
   def _evaluate(self, x, out, *args, **kwargs):
+    with self.budget.track():
+      out['F'] = self.objectives(x)
+
+  def confounding_proxy(self, x, y_hat=None):
+    # |partial correlation| of y_hat and c given y, a cheap stand-in for the CPT
+    key = x.tobytes()
+    if key not in self.proxy:
+      if y_hat is None:
+        y_hat = self.clf.predict(self.x_train * x.reshape((1,-1)))
+      self.proxy[key] = abs(partial_correlation(y_hat, self.c_train, self.y_train))
+    return self.proxy[key]
+
+  def objectives(self, x, num_perms=None):
+    # only new chromosomes are pre-screened, the front is always refined with the CPT
+    screening = self.screen is not None and num_perms is None
+    if num_perms is None:
+      num_perms = self.fidelity.num_perms(self.generation)
+    key = x.tobytes()
+    if key in self.cache and self.cache[key][1] >= num_perms:
+      return self.cache[key][0]
+
     # pymoo initialize the chromosome as a 1-D array which can be converted
     # into matrix for element-wise weight multiplication
     # fw = np.matlib.repmat(x, self.n, 1)
@@ -56,29 +92,71 @@ class MyProblem(ElementwiseProblem):
 
     # second objective is P Value from CPT
     y_hat = self.clf.predict(x_train_tf)
+    if screening:
+      proxy = self.confounding_proxy(x, y_hat)
+      f2 = self.screen.screen(f1, proxy)
+      if f2 is not None:
+        # stored with zero permutations so that it gets the CPT if it ever makes the front
+        self.cache[key] = ([f1, f2], 0)
+        return [f1, f2]
+
     ret = partial_confound_test(self.y_train, y_hat, self.c_train,
                                 cat_y=True, cat_yhat=True, cat_c=False,
                                 cond_dist_method='gam',
-                                num_perms=self.permu, mcmc_steps=50,
-                                n_jobs=-1,
+                                num_perms=num_perms, mcmc_steps=50,
+                                n_jobs=self.budget.cores,
                                 progress=False)
 
     f2 = 1 - ret.p
+    if screening:
+      self.screen.record(f1, proxy, f2)
 
-    out['F'] = [f1, f2]
+    self.fidelity.spend(num_perms)
+    self.cache[key] = ([f1, f2], num_perms)
+    return [f1, f2]
 
 class MyCallback(Callback):
-  def __init__(self) -> None:
+  def __init__(self, budget=None, problem=None, ckpt_path=None, ckpt_every=1, ckpt_config=None) -> None:
     super().__init__()
     self.data["best"] = []
+    self.budget = budget
+    self.problem = problem
+    self.ckpt_path = ckpt_path
+    self.ckpt_every = ckpt_every
+    self.ckpt_config = ckpt_config
 
   def notify(self, algorithm):
     print(f"Generation {algorithm.n_gen}")
+    # chromosomes that made the front are brought up to the fidelity of this generation
+    fidelity = self.problem.fidelity
+    refine_front(algorithm, self.problem, fidelity.num_perms(algorithm.n_gen))
+    self.problem.generation = algorithm.n_gen + 1
+    print(f"Permutations {fidelity.num_perms(algorithm.n_gen)}, total {fidelity.used}")
+
+    screen = self.problem.screen
+    if screen is not None:
+      X, F = algorithm.opt.get("X"), algorithm.opt.get("F")
+      screen.update(F, [self.problem.confounding_proxy(x) for x in X])
+      print(f"Proxy screen: skipped {screen.skipped}, agreement {screen.agreement():.2%}")
+      if WANDB: wandb.log({"ga/screen_skipped"   : screen.skipped,
+                           "ga/screen_agreement" : screen.agreement()})
+    if WANDB: wandb.log({"ga/num_perms"  : fidelity.num_perms(algorithm.n_gen),
+                         "ga/perms_used" : fidelity.used})
+    if self.budget is not None:
+      usage = self.budget.report()
+      print(f"Evaluations/s {usage['eval_per_sec']:.2f}, CPU utilization {usage['utilization']:.2%}")
+      if WANDB: wandb.log({"ga/eval_per_sec"  : usage["eval_per_sec"],
+                           "ga/utilization"   : usage["utilization"]})
     self.data["best"].append(algorithm.pop.get("F")[0].min())
     if WANDB: wandb.log({"ga/n_gen"     : algorithm.n_gen,
                          "ga/train_acc" : 1-algorithm.pop.get("F")[0].min(),
                          "ga/p_value"   : 1-algorithm.pop.get("F")[1].min()})
 
+    if self.ckpt_path and algorithm.n_gen % self.ckpt_every == 0:
+      save_checkpoint(self.ckpt_path, algorithm, cache=self.problem.cache, callback_data=self.data,
+                      config=self.ckpt_config, fidelity=self.problem.fidelity, screen=self.problem.screen)
+      print(f"Checkpoint saved to {self.ckpt_path}")
+
 if __name__ == "__main__":
 
   parser = argparse.ArgumentParser(description="sEMG GA-SVM experiments")
@@ -87,19 +165,33 @@ if __name__ == "__main__":
   parser.add_argument('-ngen',   type=int, default=1,   help="Number of generation")
   parser.add_argument('-pop',    type=int, default=64,  help='Population size')
   parser.add_argument('-perm',   type=int, default=100, help='Permutation value')
+  parser.add_argument('-perm_min', type=int, default=0, help='Permutation value of the first generation, ramped up to -perm')
   parser.add_argument('-thread', type=int, default=8,   help='Number of threads')
+  parser.add_argument('-screen', action='store_true', help='Skip the CPT of chromosomes dominated on the partial correlation proxy')
+  parser.add_argument('-audit',  type=float, default=0.1, help='Fraction of screened chromosomes still evaluated with the CPT')
+  parser.add_argument('-cores',  type=int, default=0,   help='Core budget shared by the threads and the CPT, 0 for all cores')
+  parser.add_argument('-ckpt',   type=str, default=None, help='Directory of the GA checkpoints, no checkpoints by default')
+  parser.add_argument('-ckpt_every', type=int, default=1, help='Checkpoint every n generations')
+  parser.add_argument('--resume', action='store_true', help='Resume the GA from the last checkpoint in -ckpt')
   args = parser.parse_args()
+  if args.resume and args.ckpt is None:
+    parser.error("--resume needs the checkpoint directory -ckpt")
 
   #configurations and parameters that doesn't need that are helpful when logged
   config = {"num_generation"  : args.ngen,
             "population_size" : args.pop,
             "permutation"     : args.perm,
-            "threads"         : args.thread}
+            "permutation_min" : args.perm_min,
+            "threads"         : args.thread,
+            "cores"           : args.cores,
+            "screen"          : args.screen,
+            "audit"           : args.audit}
 
   # X - FEAT_N
   # Y - LABEL
   # C - SUBJECT_SKINFOLD
-  FEAT_N, LABEL, SUBJECT_SKINFOLD, VFI_1, SUBJECT_ID = load_datafile("data/subjects_40_v6")
+  # memory-mapped from the cache shared with the transformer scripts
+  FEAT_N, LABEL, VFI_1, SUBJECT_ID, SUBJECT_SKINFOLD, offsets = load_feature_cache(DATA_CACHE, DATA_FILE)
 
   testing_acc  = np.zeros(40)
   training_acc = np.zeros(40)
@@ -112,11 +204,11 @@ if __name__ == "__main__":
   start_sub    = args.s
   num_sub      = args.nsub
   for sub_test in range(start_sub, start_sub + num_sub):
-    print(SUBJECT_ID[sub_test][0][0])
-    sub_txt = "R%03d"%(int(SUBJECT_ID[sub_test][0][0]))
-    sub_group = "Fatigued" if int(VFI_1[sub_test][0][0]) > 10 else "Healthy"
+    print(SUBJECT_ID[sub_test])
+    sub_txt = "R%03d"%(int(SUBJECT_ID[sub_test]))
+    sub_group = "Fatigued" if int(VFI_1[sub_test]) > 10 else "Healthy"
     print('\n===No.%d: %s===\n'%(sub_test+1, sub_txt))
-    print('VFI-1:', (VFI_1[sub_test][0][0]))
+    print('VFI-1:', (VFI_1[sub_test]))
 
 
     if WANDB:
@@ -127,9 +219,9 @@ if __name__ == "__main__":
                         tags     = [sub_group],
                         settings = wandb.Settings(_disable_stats=True, _disable_meta=True),
                         reinit   = True)
-      wandb.log({"subject_info/vfi_1"  : int(VFI_1[sub_test][0][0])})
+      wandb.log({"subject_info/vfi_1"  : int(VFI_1[sub_test])})
 
-    X, Y, C, X_Test, Y_Test = LoadTrainTestFeatures(FEAT_N, LABEL, SUBJECT_SKINFOLD, sub_test)
+    X, Y, C, X_Test, Y_Test, _ = partition_feature_cache(FEAT_N, LABEL, SUBJECT_SKINFOLD, offsets, sub_test)
 
     # Split training and validation (mainly for shuffle validation set technicially ot used here)
     X_Train, X_Valid, YC_Train, YC_Valid = train_test_split(X, np.transpose([Y, C]),
@@ -169,11 +261,16 @@ if __name__ == "__main__":
     population_size = config["population_size"]
     threads_count   = config["threads"]
 
-    pool = ThreadPool(threads_count)
+    # outer threads evaluating chromosomes, their CPTs share one worker pool over all the cores
+    budget = CoreBudget(cores=config["cores"], outer=threads_count)
+    print(f"Core budget: {budget.cores} cores, {budget.outer} threads, {budget.cores} CPT workers")
+    pool = budget.pool()
     runner = StarmapParallelization(pool.starmap)
 
     problem = MyProblem(elementwise_runner=runner)
-    problem.load_data_svm(X_Train, Y_Train, C_Train, clf, num_permu)
+    fidelity = FidelitySchedule(config["permutation_min"], num_permu, num_generation)
+    screen = ProxyScreen(audit=config["audit"]) if config["screen"] else None
+    problem.load_data_svm(X_Train, Y_Train, C_Train, clf, fidelity, budget, screen)
 
     # Genetic algorithm initialization
     algorithm = NSGA2(pop_size  = population_size,
@@ -181,54 +278,61 @@ if __name__ == "__main__":
                       crossover = SBX(eta=15, prob=0.9),
                       mutation  = PM(eta=20),
                       output    = MultiObjectiveOutput())
-
-    res = minimize(problem,
-                   algorithm,
-                   ("n_gen", num_generation),
-                   callback = MyCallback(),
-                   verbose=True)
+    # a checkpoint is only resumed by a run with the same subject and GA config
+    ckpt_config = {"subject": sub_txt, **{k: v for k, v in config.items() if k not in ("threads", "cores")}}
+    ckpt_path = os.path.join(args.ckpt, f"{sub_txt}.pkl") if args.ckpt else None
+    callback = MyCallback(budget, problem, ckpt_path=ckpt_path, ckpt_every=args.ckpt_every,
+                          ckpt_config=ckpt_config)
+
+    checkpoint = load_checkpoint(ckpt_path, ckpt_config) if args.resume else None
+    if checkpoint is not None:
+      print(f"Resuming from generation {checkpoint['n_gen']}")
+      problem.cache.update(checkpoint["cache"])
+      problem.generation = checkpoint["n_gen"] + 1
+      fidelity.load_state_dict(checkpoint["fidelity"])
+      if screen is not None:
+        screen.load_state_dict(checkpoint["screen"])
+      callback.data.update(checkpoint["callback"])
+      algorithm = resume_algorithm(checkpoint, problem, ("n_gen", num_generation),
+                                   callback=callback, verbose=True)
+
+    with budget.pin_threads(1):
+      res = minimize(problem,
+                     algorithm,
+                     ("n_gen", num_generation),
+                     copy_algorithm=False,
+                     callback = callback,
+                     verbose=True)
 
     print('Threads:', res.exec_time)
+    print('Core usage:', budget.report())
+    print(f'Permutations: {fidelity.used}, fixed fidelity: {res.algorithm.evaluator.n_eval * num_permu}')
     pool.close()
 
-    # Evaluate all the solutions returned by GA
-    Xid = np.argsort(res.F[:,0])
+    # Evaluate all the solutions returned by GA in one batch: the weighted features of every
+    # solution are stacked into a single predict call and the p values come from one
+    # multi-target CPT sharing the density estimate and the sampled permutations
+    W = res.X[np.argsort(res.F[:,0])]
+    S, d = np.shape(W)
+    Y_tf_train = clf.predict((X_Train[np.newaxis,:,:] * W[:,np.newaxis,:]).reshape((-1, d))).reshape((S, -1))
+    Y_tf_test  = clf.predict((X_Test[np.newaxis,:,:]  * W[:,np.newaxis,:]).reshape((-1, d))).reshape((S, -1))
+    tr_acc = np.mean(Y_tf_train == Y_Train[np.newaxis,:], axis=1)
+    te_acc = np.mean(Y_tf_test  == Y_Test[np.newaxis,:],  axis=1)
+    p_values, _ = cpt_p_multi(Y_Train, Y_tf_train, C_Train, cat_y=True, cat_yhat=True, cat_c=False, n_jobs=budget.cores)
+
     acc_best = 0
-    for t in range(np.shape(res.X)[0]):
-      w = res.X[Xid[t],:]
-
-      # Evalute training performance
-      n = np.shape(X_Train)[0]
-      fw = np.repeat(w.reshape((1,-1)), n, axis=0)
-      x_train_tf = X_Train * fw
-      Y_tf_train = clf.predict(x_train_tf)
-      temp_tr_acc = clf.score(x_train_tf, Y_Train)
-
-      # Evaluate the p value from the current predicitons
-      ret_ga = partial_confound_test(Y_Train, Y_tf_train, C_Train,
-                                     cat_y=True, cat_yhat=True, cat_c=False,
-                                     cond_dist_method='gam',
-                                     progress=False)
-      temp_p_value = ret_ga.p
-
-      # Evaluate the testing performance
-      n = np.shape(X_Test)[0]
-      fw = np.repeat(w.reshape((1,-1)), n, axis=0)
-      x_test_tf = X_Test * fw
-      Y_tf_test = clf.predict(x_test_tf)
-      temp_te_acc = accuracy_score(Y_tf_test, Y_Test)
-
-      if WANDB: wandb.log({"pareto-front/train_acc": temp_tr_acc,
-                           "pareto-front/p_value"  : temp_p_value,
-                           "pareto-front/test_acc" : temp_te_acc})
-
-      # Detect if the current chromosome gives the best predictio`n
-      if temp_te_acc > acc_best:
-        acc_best = temp_te_acc
-
-        training_acc_ga[sub_test] = temp_tr_acc
-        p_value_ga[sub_test]      = temp_p_value
-        testing_acc_ga[sub_test]  = temp_te_acc
+    for t in range(S):
+      if WANDB: wandb.log({"pareto-front/train_acc": tr_acc[t],
+                           "pareto-front/p_value"  : p_values[t],
+                           "pareto-front/test_acc" : te_acc[t]})
+
+      # Detect if the current chromosome gives the best prediction
+      if te_acc[t] > acc_best:
+        acc_best = te_acc[t]
+
+        training_acc_ga[sub_test] = tr_acc[t]
+        p_value_ga[sub_test]      = p_values[t]
+        testing_acc_ga[sub_test]  = te_acc[t]
 
     print("Training Acc after GA: ", training_acc_ga[sub_test])
     print("P Value      after GA: ", p_value_ga[sub_test])
@@ -1,188 +1,116 @@
-import copy, torch, wandb, argparse
+import os, copy, torch, wandb, argparse
 import numpy as np
-import scipy.io as sio
-import torch.nn.functional as F
 from torch import nn
 from tqdm import tqdm
-from torch.utils.data import Dataset, DataLoader
+from util.sEMGhelpers import load_signal_cache, loso_split, channel_stats
+from util.sEMGmodels import sEMGtransformer
+from util.metrics import MetricSums, count_correct
+from util.torchhelpers import Runtime, ModelSnapshot, compile_model, quantize_dynamic, parity_report, benchmark_inference
+from util.sEMGFeatureLoader import sEMGSignalDataset, to_shared_tensor, batch_loader
 from mlconfound.stats import partial_confound_test
 
-def load_raw_signals(file):
-  data = sio.loadmat(file)
-  signals = data['DATA']
-  labels = data['LABEL']
-  vfi_1 = data['SUBJECT_VFI']
-  sub_id = data['SUBJECT_ID']
-  sub_skinfold = data['SUBJECT_SKINFOLD']
-  return signals, labels, vfi_1, sub_id, sub_skinfold
-
-class sEMGSignalDataset(Dataset):
-  def __init__(self, signals, labels):
-    self.signals = signals
-    self.labels = labels
-
-  def __len__(self):
-    return len(self.labels)
-
-  def __getitem__(self, idx):
-    signal = torch.tensor(self.signals[idx,:,:], dtype=torch.float32)
-    label = torch.tensor(self.labels[idx,:], dtype=torch.float32)
-    return signal, label
-
-class sEMGtransformer(nn.Module):
-  def __init__(self, patch_size=64, d_model=512, nhead=8, dim_feedforward=2048, dropout=0.1, num_layers=1):
-    super().__init__()
-    self.patch_size = patch_size
-    self.seq_len = 4000 // patch_size
-
-    self.input_project = nn.Linear(4*self.patch_size, d_model)
-    self.dropout = nn.Dropout(dropout)
-    encoder_layer = nn.TransformerEncoderLayer(d_model=d_model, nhead=nhead, dim_feedforward=dim_feedforward, dropout=dropout,
-                                               activation=nn.GELU(), batch_first=True, norm_first=True)
-    self.transformer_encoder = nn.TransformerEncoder(encoder_layer, num_layers=num_layers)
-    self.mlp_head = nn.Linear(d_model, 2)
-
-    self.cls_token = nn.Parameter(torch.rand(1, 1, d_model))
-    self.pos_embedding = nn.Parameter(torch.randn(1, self.seq_len+1, d_model))
-
-  def forward(self, x):
-    # convert from raw signals to signal patches
-    x = x[:, :, :(x.shape[2] // self.patch_size)*self.patch_size]
-    B, C, L = x.shape
-    x = x.reshape(B, C, L//self.patch_size, self.patch_size)  # [B, C, seq_len, patch_size]
-    x = x.permute(0, 2, 1, 3).flatten(2,3)                    # [B, seq_len, C*patch_size]
-    x = self.input_project(x)                                 # [B, seq_len, d_model]
-
-    # add class token and positional embedding
-    cls_token = self.cls_token.repeat(B,1,1)
-    x = torch.cat((cls_token, x), dim=1)
-    x = x + self.pos_embedding[:,:(self.seq_len+1)]
-    x = self.dropout(x)
-
-    x = self.transformer_encoder(x)
-
-    # compare to using only the cls_token, using mean of embedding has a much smoother loss curve
-    # x = x.mean(dim=1)
-    x = x[:,0,:]
-    x = self.mlp_head(x)
-    return x
-  
-def count_correct(outputs, targets):
-  _, predicted = torch.max(F.softmax(outputs, dim=1), 1)
-  _, labels    = torch.max(targets, 1)
-  return (predicted == labels).sum().item()
+DATA_FILE  = os.getenv("DATA_FILE",  "data/subjects_40_v6.mat")
+DATA_CACHE = os.getenv("DATA_CACHE", "data/subjects_40_v6")
 
-def train(config, signals, labels, sub_id, sub_skinfold):
+def train(config, signals, labels, sub_id, sub_skinfold, offsets):
+  runtime = Runtime(config.device, config.precision, config.threads, config.interop_threads)
+  print(runtime)
   sub_test = config.sub_idx
-  print(f"Subject R{sub_id[args.sub_idx][0][0][0]}")
-
-  X, Y, C = [], [], []
-  for i in range(40):
-    # stack all inputs into [N,C,L] format
-    x = np.stack(signals[i], axis=1)
-    # one-hot encode the binary labels
-    N = labels[i][0].shape[0]
-    mapped_indices = (labels[i][0] == 1).astype(int)
-    y_onehot = np.zeros((N, 2))
-    y_onehot[np.arange(N), mapped_indices.flatten()] = 1
-
-    X.append(x)
-    Y.append(y_onehot)
-    C.append(sub_skinfold[i][0].mean(axis=1))
-
-  # normalize the signals channel-wise
-  X_means = np.mean(np.concatenate(X, axis=0), axis=(0,2))
-  X_stds = np.std(np.concatenate(X, axis=0), axis=(0,2))
-  for i in range(40):
-    X[i] = (X[i] - X_means[np.newaxis,:,np.newaxis]) / X_stds[np.newaxis,:,np.newaxis]
-  print(f"X {np.concatenate(X, axis=0).shape}")
-
-  # leave-one-out split
-  X_test, Y_test = X[sub_test], Y[sub_test]
-  X, Y, C = X[:sub_test] + X[sub_test+1:], Y[:sub_test] + Y[sub_test+1:], C[:sub_test] + C[sub_test+1:]
-  X, Y, C = np.concatenate(X, axis=0), np.concatenate(Y, axis=0), np.concatenate(C, axis=0)
-
-  num_samples = X.shape[0]
-  indices = np.arange(num_samples)
-  np.random.shuffle(indices)
-  split_idx = int(num_samples*0.9)
-  train_idx, valid_idx = indices[:split_idx], indices[split_idx:]
-
-  X_train, X_valid = X[train_idx], X[valid_idx]
-  Y_train, Y_valid = Y[train_idx], Y[valid_idx]
-  Y_train_cpt = np.argmax(Y_train, axis=1)
+  print(f"Subject R{sub_id[args.sub_idx]}")
+
+  # one-hot encode the binary labels
+  N = len(labels)
+  Y = np.zeros((N, 2))
+  Y[np.arange(N), (labels == 1).astype(int)] = 1
+  C = sub_skinfold.mean(axis=1)
+
+  # channel-wise statistics in one streaming pass over the subjects, then a single normalized
+  # float32 copy that all the splits slice their batches from, in process memory as the
+  # batches are sliced by the main process (the loaders have no workers)
+  X_means, X_stds = channel_stats(signals[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1))
+  X = to_shared_tensor(signals, X_means, X_stds, shared=False)
+  print(f"X {X.shape}")
+
+  # leave-one-subject-out split, the splits only hold row indices into X
+  train_idx, valid_idx, test_idx = loso_split(offsets, sub_test)
+  Y_train_cpt = np.argmax(Y[train_idx], axis=1)
   C_train = C[train_idx]
-  print(f"X_train {X_train.shape}")
-  print(f"X_valid {X_valid.shape}")
-  print(f"X_test {X_test.shape}")
+  print(f"X_train {(len(train_idx),) + X.shape[1:]}")
+  print(f"X_valid {(len(valid_idx),) + X.shape[1:]}")
+  print(f"X_test {(len(test_idx),) + X.shape[1:]}")
 
-  dataset_train = sEMGSignalDataset(X_train, Y_train)
-  dataset_valid = sEMGSignalDataset(X_valid, Y_valid)
-  dataset_test  = sEMGSignalDataset(X_test, Y_test)
+  dataset_train = sEMGSignalDataset(X, Y, train_idx)
+  dataset_valid = sEMGSignalDataset(X, Y, valid_idx)
+  dataset_test  = sEMGSignalDataset(X, Y, test_idx)
 
-  dataloader_train = DataLoader(dataset_train, batch_size=config.bsz, shuffle=True)
-  dataloader_train_cpt = DataLoader(dataset_train, batch_size=config.bsz, shuffle=False)
-  dataloader_valid = DataLoader(dataset_valid, batch_size=config.bsz, shuffle=False)
-  dataloader_test  = DataLoader(dataset_test,  batch_size=config.bsz, shuffle=False)
+  dataloader_train = batch_loader(dataset_train, config.bsz, shuffle=True)
+  dataloader_train_cpt = batch_loader(dataset_train, config.bsz, shuffle=False)
+  dataloader_valid = batch_loader(dataset_valid, config.bsz, shuffle=False)
+  dataloader_test  = batch_loader(dataset_test,  config.bsz, shuffle=False)
 
   model = sEMGtransformer(patch_size=config.psz, d_model=config.d_model, nhead=config.nhead, dim_feedforward=config.dim_feedforward,
-                          dropout=config.dropout, num_layers=config.num_layers)
-  model.to("cuda")
+                          dropout=config.dropout, num_layers=config.num_layers, window=X.shape[2])
+  model = runtime.model(model)
+  # the compiled forward shares the parameters of model, which is still the one saved and copied
+  forward = compile_model(model) if config.compile else model
 
   criterion = nn.CrossEntropyLoss()
   optimizer = torch.optim.AdamW(model.parameters(), lr=config.lr)
   scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=config.step_size, gamma=config.gamma)
-  scaler = torch.cuda.amp.GradScaler()
+  scaler = runtime.grad_scaler()
 
   accuracy_valid_best = 0
   accuracy_test_best = 0
+  # the best epoch is only kept for the int8 export
+  snapshot = ModelSnapshot(model) if config.quantize else None
   for epoch in tqdm(range(config.epochs), desc="Training"):
-    loss_train = 0
-    correct_train = 0
+    metrics = MetricSums()
     model.train()
     for batch, (inputs, targets) in enumerate(dataloader_train):
-      inputs, targets = inputs.to("cuda"), targets.to("cuda")
+      inputs, targets = inputs.to(runtime.device), targets.to(runtime.device)
       optimizer.zero_grad()
-      with torch.autocast(device_type="cuda", dtype=torch.float16):
-        outputs = model(inputs)
+      with runtime.autocast():
+        outputs = forward(inputs)
         loss = criterion(outputs, targets)
 
       scaler.scale(loss).backward()
       scaler.step(optimizer)
       scaler.update()
 
-      correct_train += count_correct(outputs, targets)
-      loss_train += loss.item()
+      metrics.add(loss=loss, correct=count_correct(outputs, targets))
+    loss_train, correct_train = metrics.read("loss", "correct")
 
     wandb.log({"loss/train": loss_train/len(dataset_train), "accuracy/train": correct_train/len(dataset_train)}, step=epoch)
 
-    loss_valid = 0
-    correct_valid = 0
+    metrics = MetricSums()
     model.eval()
     for inputs, targets in dataloader_valid:
-      inputs, targets = inputs.to("cuda"), targets.to("cuda")
-      outputs = model(inputs)
+      inputs, targets = inputs.to(runtime.device), targets.to(runtime.device)
+      outputs = forward(inputs)
       loss = criterion(outputs, targets)
-      correct_valid += count_correct(outputs, targets)
-      loss_valid += loss.item()
+      metrics.add(loss=loss, correct=count_correct(outputs, targets))
+    loss_valid, correct_valid = metrics.read("loss", "correct")
 
     wandb.log({"loss/valid": loss_valid/len(dataset_valid), "accuracy/valid": correct_valid/len(dataset_valid)}, step=epoch)
 
     if correct_valid/len(dataset_valid) > accuracy_valid_best: 
       accuracy_valid_best = correct_valid/len(dataset_valid)
-      correct_test = 0
+      if snapshot is not None:
+        snapshot.update(model)
+      metrics = MetricSums()
       for inputs, targets in dataloader_test:
-        inputs, targets = inputs.to("cuda"), targets.to("cuda")
-        outputs = model(inputs)
-        correct_test += count_correct(outputs, targets)
+        inputs, targets = inputs.to(runtime.device), targets.to(runtime.device)
+        outputs = forward(inputs)
+        metrics.add(correct=count_correct(outputs, targets))
+      correct_test, = metrics.read("correct")
       accuracy_test_best = correct_test/len(dataset_test)
 
       # cpt evaluation
       Y_pred = []
       for inputs, targets in dataloader_train_cpt:
-        inputs, targets = inputs.to("cuda"), targets.to("cuda")
-        outputs = model(inputs)
-        _, predicted = torch.max(F.softmax(outputs, dim=1), 1)
+        inputs, targets = inputs.to(runtime.device), targets.to(runtime.device)
+        outputs = forward(inputs)
+        predicted = outputs.argmax(dim=1)
         Y_pred.append(predicted.cpu().numpy())
       Y_pred_cpt = np.concatenate(Y_pred, axis=0)
       ret = partial_confound_test(Y_train_cpt, Y_pred_cpt, C_train, cat_y=True, cat_yhat=True, cat_c=False)
@@ -196,6 +124,17 @@ def train(config, signals, labels, sub_id, sub_skinfold):
   print(f"accuracy_test_best: {accuracy_test_best}")
   print(f"P-value: {ret.p}")
 
+  if config.quantize:
+    # int8 CPU inference model of the best epoch, checked against its fp32 model on the test subject
+    model_best = snapshot.module(model)
+    model_int8 = quantize_dynamic(model_best)
+    parity = parity_report(model_best, model_int8, dataloader_test, lambda out, y: (out.argmax(dim=1) == y.argmax(dim=1)).sum())
+    print(f"Accuracy fp32 {parity['reference']:.4f}, int8 {parity['quantized']:.4f}, max logit difference {parity['max_abs_diff']:.4f}")
+    inputs, _ = next(iter(dataloader_test))
+    benchmark_inference({"fp32": copy.deepcopy(model_best).eval().cpu(), "int8": model_int8}, inputs)
+    torch.save(model_int8, f"R{sub_id[config.sub_idx]}_model_int8.pth")
+    wandb.log({"accuracy/test_int8": parity["quantized"]})
+
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description="sEMG transformer training configurations")
@@ -217,15 +156,22 @@ if __name__ == "__main__":
   parser.add_argument('--dim_feedforward', type=int, default=1024, help="transformer feed-forward dim")
   parser.add_argument('--num_layers', type=int, default=3, help="number of transformer encoder layers")
   parser.add_argument('--dropout', type=float, default=0.3, help="dropout rate")
+  # runtime config
+  parser.add_argument('--device', type=str, default=None, help="cuda or cpu, cuda when available by default")
+  parser.add_argument('--precision', type=str, default="auto", choices=["auto", "fp32", "fp16", "bf16"], help="autocast precision, fp16 on cuda and bf16 on cpu for auto")
+  parser.add_argument('--threads', type=int, default=0, help="intra-op threads, 0 for the torch default")
+  parser.add_argument('--interop_threads', type=int, default=0, help="inter-op threads, 0 for the torch default")
+  parser.add_argument('--compile', action='store_true', help="run the model through torch.compile, eager if it fails")
+  parser.add_argument('--quantize', action='store_true', help="export an int8 CPU inference model after training")
   args = parser.parse_args()
 
   # load data
-  signals, labels, vfi_1, sub_id, sub_skinfold = load_raw_signals("data/subjects_40_v6.mat")
+  signals, labels, vfi_1, sub_id, sub_skinfold, offsets = load_signal_cache(DATA_CACHE, DATA_FILE)
 
-  wandb.init(project="sEMG_transformers", name=f"R{sub_id[args.sub_idx][0][0][0]}", config=args)
+  wandb.init(project="sEMG_transformers", name=f"R{sub_id[args.sub_idx]}", config=args)
   config = wandb.config
 
   np.random.seed(config.seed)
   torch.manual_seed(config.seed)
 
-  train(config, signals, labels, sub_id, sub_skinfold)
\ No newline at end of file
+  train(config, signals, labels, sub_id, sub_skinfold, offsets)
\ No newline at end of file
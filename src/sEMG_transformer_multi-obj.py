@@ -1,13 +1,14 @@
-import copy, torch, wandb, argparse
+import os, torch, wandb, argparse
 import numpy as np
-import scipy.io as sio
 import torch.nn.functional as F
 from torch import nn
 from tqdm import tqdm
-from copy import deepcopy
-from torch.utils.data import Dataset, DataLoader
+from util.sEMGhelpers import load_signal_cache, loso_split, channel_stats
+from util.sEMGmodels import sEMGtransformer
+from util.metrics import MetricSums, count_correct
+from util.torchhelpers import Runtime, ModelSnapshot, compile_model
+from util.sEMGFeatureLoader import sEMGSignalDataset, to_shared_tensor, batch_loader
 from mlconfound.stats import partial_confound_test
-from multiprocessing.pool import ThreadPool
 from pymoo.optimize import minimize
 from pymoo.operators.mutation.pm import PM
 from pymoo.algorithms.moo.nsga2 import NSGA2
@@ -16,217 +17,232 @@ from pymoo.core.problem import StarmapParallelization
 from pymoo.util.display.multi import MultiObjectiveOutput
 from pymoo.operators.sampling.rnd import FloatRandomSampling
 from pymoo.core.problem import ElementwiseProblem
-
-def load_raw_signals(file):
-  data = sio.loadmat(file)
-  signals = data['DATA']
-  labels = data['LABEL']
-  vfi_1 = data['SUBJECT_VFI']
-  sub_id = data['SUBJECT_ID']
-  sub_skinfold = data['SUBJECT_SKINFOLD']
-  return signals, labels, vfi_1, sub_id, sub_skinfold
-
-class sEMGSignalDataset(Dataset):
-  def __init__(self, signals, labels):
-    self.signals = signals
-    self.labels = labels
-
-  def __len__(self):
-    return len(self.labels)
-
-  def __getitem__(self, idx):
-    signal = torch.tensor(self.signals[idx,:,:], dtype=torch.float32)
-    label = torch.tensor(self.labels[idx,:], dtype=torch.float32)
-    return signal, label
-
-class sEMGtransformer(nn.Module):
-  def __init__(self, patch_size=64, d_model=512, nhead=8, dim_feedforward=2048, dropout=0.1, num_layers=1):
-    super().__init__()
-    self.patch_size = patch_size
-    self.seq_len = 4000 // patch_size
-
-    self.input_project = nn.Linear(4*self.patch_size, d_model)
-    self.dropout = nn.Dropout(dropout)
-    encoder_layer = nn.TransformerEncoderLayer(d_model=d_model, nhead=nhead, dim_feedforward=dim_feedforward, dropout=dropout,
-                                               activation=nn.GELU(), batch_first=True, norm_first=True)
-    self.transformer_encoder = nn.TransformerEncoder(encoder_layer, num_layers=num_layers)
-    self.mlp_head = nn.Linear(d_model, 2)
-
-    self.cls_token = nn.Parameter(torch.rand(1, 1, d_model))
-    self.pos_embedding = nn.Parameter(torch.randn(1, self.seq_len+1, d_model))
-
-  def forward(self, x):
-    # convert from raw signals to signal patches
-    x = x[:, :, :(x.shape[2] // self.patch_size)*self.patch_size]
-    B, C, L = x.shape
-    x = x.reshape(B, C, L//self.patch_size, self.patch_size)  # [B, C, seq_len, patch_size]
-    x = x.permute(0, 2, 1, 3).flatten(2,3)                    # [B, seq_len, C*patch_size]
-    x = self.input_project(x)                                 # [B, seq_len, d_model]
-
-    # add class token and positional embedding
-    cls_token = self.cls_token.repeat(B,1,1)
-    x = torch.cat((cls_token, x), dim=1)
-    x = x + self.pos_embedding[:,:(self.seq_len+1)]
-    x = self.dropout(x)
-
-    x = self.transformer_encoder(x)
-
-    # compare to using only the cls_token, using mean of embedding has a much smoother loss curve
-    # x = x.mean(dim=1)
-    x = x[:,0,:]
-    x = self.mlp_head(x)
-    return x
+from pymoo.core.callback import Callback
+from cpt import cpt_p_multi
+from util.GAhelpers import CoreBudget, FidelitySchedule, refine_front, save_checkpoint, load_checkpoint, \
+                           check_config, resume_algorithm
+
+DATA_FILE  = os.getenv("DATA_FILE",  "data/subjects_40_v6.mat")
+DATA_CACHE = os.getenv("DATA_CACHE", "data/subjects_40_v6")
+
+# arguments that do not change the results, left out of the config a checkpoint is resumed with
+RUNTIME_ARGS = ["device", "precision", "threads", "interop_threads", "compile",
+                "thread", "cores", "ckpt_dir", "ckpt_every", "resume"]
+GA_ARGS      = ["ngen", "pop", "perm", "perm_min"]
+
+def extract_features(model, dataloader, device):
+  # inputs of mlp_head, the only layer the GA changes, so they are shared by every chromosome
+  model.eval()
+  Z, Y = [], []
+  with torch.no_grad():
+    for inputs, targets in dataloader:
+      Z.append(model.features(inputs.to(device)))
+      Y.append(targets.to(device))
+  return torch.cat(Z, dim=0), torch.cat(Y, dim=0)
 
 class OptimizeMLPLayer(ElementwiseProblem):
   def __init__(self, n_var=512, n_obj=2, n_constr=0, xl = -1*np.ones(512), xu = 1*np.ones(512), **kwargs):
     super().__init__(n_var=n_var, n_obj=n_obj, n_constr=n_constr, xl = xl, xu = xu, **kwargs)
 
-  def load_data(self, x_train, y_train, y_train_cpt, c_train, clf, perm):
-    self.clf = clf.to("cuda")
-    self.x_train = torch.tensor(x_train, dtype=torch.float, device="cuda")
-    self.y_train = torch.tensor(y_train, dtype=torch.float, device="cuda")
+  def load_data(self, z_train, y_train, y_train_cpt, c_train, bias, fidelity, budget):
+    # z_train - mlp_head inputs of the training samples from extract_features()
+    # bias    - mlp_head bias, the chromosome only replaces the weight
+    self.z_train = z_train
+    self.y_train = y_train
+    self.bias = bias
     self.y_train_cpt = y_train_cpt
     self.criterion = nn.CrossEntropyLoss()
     self.c_train = c_train
-    self.perm = perm
+    self.fidelity = fidelity
+    self.budget = budget
+    # fitness cache keyed by the chromosome bytes, it stores the objectives together with
+    # the number of permutations they were computed with and is saved with the checkpoints
+    self.cache = {}
+    # generation whose offspring are being evaluated, updated by MyCallback
+    self.generation = 1
 
   def _evaluate(self, x, out, *args, **kwargs):
+    with self.budget.track():
+      out['F'] = self.objectives(x)
+
+  def objectives(self, x, num_perms=None):
+    if num_perms is None:
+      num_perms = self.fidelity.num_perms(self.generation)
+    key = x.tobytes()
+    if key in self.cache and self.cache[key][1] >= num_perms:
+      return self.cache[key][0]
+
     with torch.no_grad():
-      weight = torch.tensor(x.reshape((2,256)), dtype=torch.float, device="cuda")
-      clf_copy = deepcopy(self.clf)
-      clf_copy.mlp_head.weight.data = weight
-      output = clf_copy(self.x_train)
+      weight = torch.tensor(x.reshape((2,-1)), dtype=torch.float, device=self.z_train.device)
+      output = F.linear(self.z_train, weight, self.bias)
       cross_entropy_loss = self.criterion(output, self.y_train)
 
-      _, predicted = torch.max(F.softmax(output, dim=1), 1)
-      y_pred_cpt = np.array(predicted.to("cpu"))
-      ret = partial_confound_test(self.y_train_cpt, y_pred_cpt, self.c_train, cat_y=True, cat_yhat=True, cat_c=False, progress=False)
-
-      out['F'] = [cross_entropy_loss.to("cpu").numpy(), 1-ret.p]
+      y_pred_cpt = output.argmax(dim=1).cpu().numpy()
+      ret = partial_confound_test(self.y_train_cpt, y_pred_cpt, self.c_train, cat_y=True, cat_yhat=True, cat_c=False,
+                                  num_perms=num_perms, n_jobs=self.budget.cores, progress=False)
 
-def count_correct(outputs, targets):
-  _, predicted = torch.max(F.softmax(outputs, dim=1), 1)
-  _, labels    = torch.max(targets, 1)
-  return (predicted == labels).sum().item()
+      self.fidelity.spend(num_perms)
+      self.cache[key] = ([cross_entropy_loss.to("cpu").numpy(), 1-ret.p], num_perms)
+      return self.cache[key][0]
 
-def train(config, signals, labels, sub_id, sub_skinfold):
+class MyCallback(Callback):
+  def __init__(self, budget=None, problem=None, ckpt_path=None, ckpt_every=1, ckpt_config=None) -> None:
+    super().__init__()
+    self.data["best"] = []
+    self.budget = budget
+    self.problem = problem
+    self.ckpt_path = ckpt_path
+    self.ckpt_every = ckpt_every
+    self.ckpt_config = ckpt_config
+
+  def notify(self, algorithm):
+    # chromosomes that made the front are brought up to the fidelity of this generation
+    fidelity = self.problem.fidelity
+    refine_front(algorithm, self.problem, fidelity.num_perms(algorithm.n_gen))
+    self.problem.generation = algorithm.n_gen + 1
+
+    F = algorithm.pop.get("F")
+    self.data["best"].append(F[:,0].min())
+    log = {"ga/n_gen": algorithm.n_gen, "ga/loss": F[:,0].min(), "ga/p_value": 1-F[:,1].min(),
+           "ga/num_perms": fidelity.num_perms(algorithm.n_gen), "ga/perms_used": fidelity.used}
+    if self.budget is not None:
+      usage = self.budget.report()
+      log.update({"ga/eval_per_sec": usage["eval_per_sec"], "ga/utilization": usage["utilization"]})
+    wandb.log(log)
+
+    if self.ckpt_path and algorithm.n_gen % self.ckpt_every == 0:
+      save_checkpoint(self.ckpt_path, algorithm, cache=self.problem.cache, callback_data=self.data,
+                      config=self.ckpt_config, fidelity=self.problem.fidelity)
+
+def train(config, signals, labels, sub_id, sub_skinfold, offsets):
+  runtime = Runtime(config.device, config.precision, config.threads, config.interop_threads)
+  print(runtime)
   sub_test = config.sub_idx
-  print(f"Subject R{sub_id[args.sub_idx][0][0][0]}")
-
-  X, Y, C = [], [], []
-  for i in range(40):
-    # stack all inputs into [N,C,L] format
-    x = np.stack(signals[i], axis=1)
-    # one-hot encode the binary labels
-    N = labels[i][0].shape[0]
-    mapped_indices = (labels[i][0] == 1).astype(int)
-    y_onehot = np.zeros((N, 2))
-    y_onehot[np.arange(N), mapped_indices.flatten()] = 1
-
-    X.append(x)
-    Y.append(y_onehot)
-    C.append(sub_skinfold[i][0].mean(axis=1))
-
-  # normalize the signals channel-wise
-  X_means = np.mean(np.concatenate(X, axis=0), axis=(0,2))
-  X_stds = np.std(np.concatenate(X, axis=0), axis=(0,2))
-  for i in range(40):
-    X[i] = (X[i] - X_means[np.newaxis,:,np.newaxis]) / X_stds[np.newaxis,:,np.newaxis]
-  print(f"X {np.concatenate(X, axis=0).shape}")
-
-  # leave-one-out split
-  X_test, Y_test = X[sub_test], Y[sub_test]
-  X, Y, C = X[:sub_test] + X[sub_test+1:], Y[:sub_test] + Y[sub_test+1:], C[:sub_test] + C[sub_test+1:]
-  X, Y, C = np.concatenate(X, axis=0), np.concatenate(Y, axis=0), np.concatenate(C, axis=0)
-
-  num_samples = X.shape[0]
-  indices = np.arange(num_samples)
-  np.random.shuffle(indices)
-  split_idx = int(num_samples*0.9)
-  train_idx, valid_idx = indices[:split_idx], indices[split_idx:]
-
-  X_train, X_valid = X[train_idx], X[valid_idx]
-  Y_train, Y_valid = Y[train_idx], Y[valid_idx]
-  Y_train_cpt = np.argmax(Y_train, axis=1)
+  sub_txt = f"R{sub_id[sub_test]}"
+  print(f"Subject {sub_txt}")
+
+  # the trained model is checkpointed before the GA so that a resumed run can skip training
+  ckpt_path  = os.path.join(config.ckpt_dir, f"{sub_txt}_ga.pkl")
+  model_path = os.path.join(config.ckpt_dir, f"{sub_txt}_model.pth")
+  resume = config.resume and os.path.exists(model_path)
+  # the model is resumed by runs with the same training config, the GA by runs with the same GA config too
+  ga_config    = {k: config[k] for k in config.keys() if k not in RUNTIME_ARGS}
+  model_config = {k: v for k, v in ga_config.items() if k not in GA_ARGS}
+
+  # one-hot encode the binary labels
+  N = len(labels)
+  Y = np.zeros((N, 2))
+  Y[np.arange(N), (labels == 1).astype(int)] = 1
+  C = sub_skinfold.mean(axis=1)
+
+  # channel-wise statistics in one streaming pass over the subjects, then a single normalized
+  # float32 copy that all the splits slice their batches from, in process memory as the
+  # batches are sliced by the main process (the loaders have no workers)
+  X_means, X_stds = channel_stats(signals[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1))
+  X = to_shared_tensor(signals, X_means, X_stds, shared=False)
+  print(f"X {X.shape}")
+
+  # leave-one-subject-out split, the splits only hold row indices into X
+  train_idx, valid_idx, test_idx = loso_split(offsets, sub_test)
+  Y_train_cpt = np.argmax(Y[train_idx], axis=1)
   C_train = C[train_idx]
-  print(f"X_train {X_train.shape}")
-  print(f"X_valid {X_valid.shape}")
-  print(f"X_test {X_test.shape}")
+  print(f"X_train {(len(train_idx),) + X.shape[1:]}")
+  print(f"X_valid {(len(valid_idx),) + X.shape[1:]}")
+  print(f"X_test {(len(test_idx),) + X.shape[1:]}")
 
-  dataset_train = sEMGSignalDataset(X_train, Y_train)
-  dataset_valid = sEMGSignalDataset(X_valid, Y_valid)
-  dataset_test  = sEMGSignalDataset(X_test, Y_test)
+  dataset_train = sEMGSignalDataset(X, Y, train_idx)
+  dataset_valid = sEMGSignalDataset(X, Y, valid_idx)
+  dataset_test  = sEMGSignalDataset(X, Y, test_idx)
 
-  dataloader_train     = DataLoader(dataset_train, batch_size=config.bsz, shuffle=True)
-  dataloader_train_cpt = DataLoader(dataset_train, batch_size=config.bsz, shuffle=False)
-  dataloader_valid     = DataLoader(dataset_valid, batch_size=config.bsz, shuffle=False)
-  dataloader_test      = DataLoader(dataset_test,  batch_size=config.bsz, shuffle=False)
+  dataloader_train     = batch_loader(dataset_train, config.bsz, shuffle=True)
+  dataloader_train_cpt = batch_loader(dataset_train, config.bsz, shuffle=False)
+  dataloader_valid     = batch_loader(dataset_valid, config.bsz, shuffle=False)
+  dataloader_test      = batch_loader(dataset_test,  config.bsz, shuffle=False)
 
   model = sEMGtransformer(patch_size=config.psz, d_model=config.d_model, nhead=config.nhead, dim_feedforward=config.dim_feedforward,
-                          dropout=config.dropout, num_layers=config.num_layers)
-  model.to("cuda")
+                          dropout=config.dropout, num_layers=config.num_layers, window=X.shape[2])
+  model = runtime.model(model)
+  # the compiled forward shares the parameters of model, which is still the one saved and copied
+  forward = compile_model(model) if config.compile else model
 
   criterion = nn.CrossEntropyLoss()
   optimizer = torch.optim.AdamW(model.parameters(), lr=config.lr)
   scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=config.step_size, gamma=config.gamma)
-  scaler = torch.cuda.amp.GradScaler()
+  scaler = runtime.grad_scaler()
 
   accuracy_train_best = 0
   accuracy_valid_best = 0
   accuracy_test_best = 0
-  model_best = None
-  for epoch in tqdm(range(config.epochs), desc="Training"):
-    loss_train = 0
-    correct_train = 0
+  snapshot = ModelSnapshot(model)
+  for epoch in tqdm(range(0 if resume else config.epochs), desc="Training"):
+    metrics = MetricSums()
     model.train()
     for batch, (inputs, targets) in enumerate(dataloader_train):
-      inputs, targets = inputs.to("cuda"), targets.to("cuda")
+      inputs, targets = inputs.to(runtime.device), targets.to(runtime.device)
       optimizer.zero_grad()
-      with torch.autocast(device_type="cuda", dtype=torch.float16):
-        outputs = model(inputs)
+      with runtime.autocast():
+        outputs = forward(inputs)
         loss = criterion(outputs, targets)
 
       scaler.scale(loss).backward()
       scaler.step(optimizer)
       scaler.update()
 
-      correct_train += count_correct(outputs, targets)
-      loss_train += loss.item()
+      metrics.add(loss=loss, correct=count_correct(outputs, targets))
+    loss_train, correct_train = metrics.read("loss", "correct")
 
     wandb.log({"loss/train": loss_train/len(dataset_train), "accuracy/train": correct_train/len(dataset_train)}, step=epoch)
 
-    loss_valid = 0
-    correct_valid = 0
+    metrics = MetricSums()
     model.eval()
     for inputs, targets in dataloader_valid:
-      inputs, targets = inputs.to("cuda"), targets.to("cuda")
-      outputs = model(inputs)
+      inputs, targets = inputs.to(runtime.device), targets.to(runtime.device)
+      outputs = forward(inputs)
       loss = criterion(outputs, targets)
-      correct_valid += count_correct(outputs, targets)
-      loss_valid += loss.item()
+      metrics.add(loss=loss, correct=count_correct(outputs, targets))
+    loss_valid, correct_valid = metrics.read("loss", "correct")
 
     wandb.log({"loss/valid": loss_valid/len(dataset_valid), "accuracy/valid": correct_valid/len(dataset_valid)}, step=epoch)
 
     if correct_valid/len(dataset_valid) > accuracy_valid_best:
       accuracy_train_best = correct_train/len(dataset_train)
       accuracy_valid_best = correct_valid/len(dataset_valid)
-      model_best = copy.deepcopy(model)
-      correct_test = 0
+      snapshot.update(model)
+      metrics = MetricSums()
       for inputs, targets in dataloader_test:
-        inputs, targets = inputs.to("cuda"), targets.to("cuda")
-        outputs = model(inputs)
-        correct_test += count_correct(outputs, targets)
+        inputs, targets = inputs.to(runtime.device), targets.to(runtime.device)
+        outputs = forward(inputs)
+        metrics.add(correct=count_correct(outputs, targets))
+      correct_test, = metrics.read("correct")
       accuracy_test_best = correct_test/len(dataset_test)
       wandb.log({"accuracy/test": correct_test/len(dataset_test)}, step=epoch)
 
     scheduler.step()
 
-  Y_train_cpt = np.argmax(Y_train, axis=1)
+  if resume:
+    print(f"Resuming from {model_path}")
+    saved = torch.load(model_path, map_location=runtime.device)
+    check_config(saved.get("config"), model_config, model_path)
+    model.load_state_dict(saved["model"])
+    model_best = model
+    accuracy_train_best = saved["accuracy_train_best"]
+    accuracy_valid_best = saved["accuracy_valid_best"]
+    accuracy_test_best  = saved["accuracy_test_best"]
+  else:
+    # only the final best is rebuilt into a module, the snapshot is written while the CPT and the GA run
+    model_best = snapshot.module(model)
+    os.makedirs(config.ckpt_dir, exist_ok=True)
+    snapshot.save_async(model_path,
+                        accuracy_train_best = accuracy_train_best,
+                        accuracy_valid_best = accuracy_valid_best,
+                        accuracy_test_best  = accuracy_test_best,
+                        config              = model_config)
+
   Y_pred = []
   for inputs, targets in dataloader_train_cpt:
-    inputs, targets = inputs.to("cuda"), targets.to("cuda")
+    inputs, targets = inputs.to(runtime.device), targets.to(runtime.device)
     outputs = model_best(inputs)
-    _, predicted = torch.max(F.softmax(outputs, dim=1), 1)
+    predicted = outputs.argmax(dim=1)
     Y_pred.append(predicted.cpu().numpy())
   Y_pred_cpt = np.concatenate(Y_pred, axis=0)
   ret = partial_confound_test(Y_train_cpt, Y_pred_cpt, C_train, cat_y=True, cat_yhat=True, cat_c=False)
@@ -248,10 +264,15 @@ def train(config, signals, labels, sub_id, sub_skinfold):
     xl = np.ones(512) * model_best.mlp_head.weight.min().cpu().numpy()
     xu = np.ones(512) * model_best.mlp_head.weight.max().cpu().numpy()
 
-    pool = ThreadPool(config.thread)
+    # outer threads evaluating chromosomes, their CPTs share one worker pool over all the cores
+    budget = CoreBudget(cores=config.cores, outer=config.thread)
+    print(f"Core budget: {budget.cores} cores, {budget.outer} threads, {budget.cores} CPT workers")
+    pool = budget.pool()
     runner = StarmapParallelization(pool.starmap)
     problem = OptimizeMLPLayer(elementwise_runner=runner)
-    problem.load_data(X_train, Y_train, Y_train_cpt, C_train, model_best, config.perm)
+    fidelity = FidelitySchedule(config.perm_min, config.perm, config.ngen)
+    Z_train, T_train = extract_features(model_best, dataloader_train_cpt, runtime.device)
+    problem.load_data(Z_train, T_train, Y_train_cpt, C_train, model_best.mlp_head.bias, fidelity, budget)
 
     # Genetic algorithm initialization
     algorithm = NSGA2(pop_size  = config.pop,
@@ -259,70 +280,73 @@ def train(config, signals, labels, sub_id, sub_skinfold):
                       crossover = SBX(eta=15, prob=0.9),
                       mutation  = PM(eta=20),
                       output    = MultiObjectiveOutput())
-
-    res = minimize(problem,
-                   algorithm,
-                   ("n_gen", config.ngen),
-                   verbose=True)
+    callback = MyCallback(budget, problem, ckpt_path=ckpt_path, ckpt_every=config.ckpt_every,
+                          ckpt_config=ga_config)
+
+    checkpoint = load_checkpoint(ckpt_path, ga_config) if resume else None
+    if checkpoint is not None:
+      print(f"Resuming from generation {checkpoint['n_gen']}")
+      problem.cache.update(checkpoint["cache"])
+      problem.generation = checkpoint["n_gen"] + 1
+      fidelity.load_state_dict(checkpoint["fidelity"])
+      callback.data.update(checkpoint["callback"])
+      algorithm = resume_algorithm(checkpoint, problem, ("n_gen", config.ngen),
+                                   callback=callback, verbose=True)
+
+    # the feature extraction before and after keeps all the torch threads
+    with budget.pin_threads(1):
+      res = minimize(problem,
+                     algorithm,
+                     ("n_gen", config.ngen),
+                     copy_algorithm=False,
+                     callback=callback,
+                     verbose=True)
 
     print('Completed! ', res.exec_time)
+    print('Core usage:', budget.report())
+    print(f'Permutations: {fidelity.used}, fixed fidelity: {res.algorithm.evaluator.n_eval * config.perm}')
     pool.close()
     print(res.F)
 
-    # Evaluate the results from GA optimization
+    # Evaluate the results from GA optimization in one batch: the mlp_head inputs are computed once
+    # per split, the heads of all solutions are applied together and the p values come from one
+    # multi-target CPT sharing the density estimate and the sampled permutations
+    Z_valid, T_valid = extract_features(model_best, dataloader_valid, runtime.device)
+    Z_test,  T_test  = extract_features(model_best, dataloader_test, runtime.device)
+    W = torch.tensor(res.X.reshape((len(res.X), 2, -1)), dtype=torch.float32, device=runtime.device)
+    bias = model_best.mlp_head.bias
+
+    def predict_front(Z, T):
+      predicted = (torch.einsum("nd,sod->sno", Z, W) + bias).argmax(dim=2)    # [S, N]
+      correct = (predicted == T.argmax(dim=1)).sum(dim=1)
+      return predicted.cpu().numpy(), correct.cpu().numpy()
+
+    Y_pred_train, correct_train = predict_front(Z_train, T_train)
+    _,            correct_valid = predict_front(Z_valid, T_valid)
+    _,            correct_test  = predict_front(Z_test,  T_test)
+    p_values, _ = cpt_p_multi(Y_train_cpt, Y_pred_train, C_train, cat_y=True, cat_yhat=True, cat_c=False, n_jobs=budget.cores)
+
     accuracy_train_best_cpt = 0
     accuracy_valid_best_cpt = 0
     accuracy_test_best_cpt = 0
     p_value_best_cpt = 0
     for i in range(len(res.X)):
-      weight = torch.tensor(res.X[i,:].reshape((2,256)), dtype=torch.float32, device="cuda")
-      model_copy = copy.deepcopy(model)
-      model_copy.mlp_head.weight.data = weight
-      model_copy.eval()
-
-      # re-calcualte training accuracy and p-value
-      correct_train = 0
-      Y_pred = []
-      for inputs, targets in dataloader_train_cpt:
-        inputs, targets = inputs.to("cuda"), targets.to("cuda")
-        outputs = model_copy(inputs)
-        correct_train += count_correct(outputs, targets)
-        _, predicted = torch.max(F.softmax(outputs, dim=1), 1)
-        Y_pred.append(predicted.cpu().numpy())
-
-      print(f"\nTraining Accuracy: {correct_train/len(dataset_train)}")
-      Y_pred_cpt = np.concatenate(Y_pred, axis=0)
-      ret = partial_confound_test(Y_train_cpt, Y_pred_cpt, C_train, cat_y=True, cat_yhat=True, cat_c=False, progress=False)
-      print(f"P-value: {ret.p}")
-
-      # re-calculate validation accuracy
-      correct_valid = 0
-      for inputs, targets in dataloader_valid:
-        inputs, targets = inputs.to("cuda"), targets.to("cuda")
-        outputs = model_copy(inputs)
-        correct_valid += count_correct(outputs, targets)
-
-      print(f"Validation Accuracy: {correct_valid/len(dataset_valid)}")
-
-      # re-calculate testing accuracy
-      correct_test = 0
-      for inputs, targets in dataloader_test:
-        inputs, targets = inputs.to("cuda"), targets.to("cuda")
-        outputs = model_copy(inputs)
-        correct_test += count_correct(outputs, targets)
-
-      print(f"Testing Accuracy: {correct_test/len(dataset_test)}")
+      print(f"\nTraining Accuracy: {correct_train[i]/len(dataset_train)}")
+      print(f"P-value: {p_values[i]}")
+      print(f"Validation Accuracy: {correct_valid[i]/len(dataset_valid)}")
+      print(f"Testing Accuracy: {correct_test[i]/len(dataset_test)}")
 
-      if correct_test/len(dataset_test) > accuracy_test_best_cpt:
-        accuracy_test_best_cpt = correct_test/len(dataset_test)
-        accuracy_train_best_cpt = correct_train/len(dataset_train)
-        accuracy_valid_best_cpt = correct_valid/len(dataset_valid)
-        p_value_best_cpt = ret.p
+      if correct_test[i]/len(dataset_test) > accuracy_test_best_cpt:
+        accuracy_test_best_cpt = correct_test[i]/len(dataset_test)
+        accuracy_train_best_cpt = correct_train[i]/len(dataset_train)
+        accuracy_valid_best_cpt = correct_valid[i]/len(dataset_valid)
+        p_value_best_cpt = p_values[i]
 
   wandb.log({"result/p-value-cpt": p_value_best_cpt,
              "result/training-cpt": accuracy_train_best_cpt,
              "result/validation-cpt": accuracy_valid_best_cpt,
              "result/testing-cpt": accuracy_test_best_cpt})
+  snapshot.wait()
 
 
 if __name__ == "__main__":
@@ -345,22 +369,33 @@ if __name__ == "__main__":
   parser.add_argument('--dim_feedforward', type=int, default=1024, help="transformer feed-forward dim")
   parser.add_argument('--num_layers', type=int, default=3, help="number of transformer encoder layers")
   parser.add_argument('--dropout', type=float, default=0.3, help="dropout rate")
+  # runtime config
+  parser.add_argument('--device', type=str, default=None, help="cuda or cpu, cuda when available by default")
+  parser.add_argument('--precision', type=str, default="auto", choices=["auto", "fp32", "fp16", "bf16"], help="autocast precision, fp16 on cuda and bf16 on cpu for auto")
+  parser.add_argument('--threads', type=int, default=0, help="intra-op threads, 0 for the torch default")
+  parser.add_argument('--interop_threads', type=int, default=0, help="inter-op threads, 0 for the torch default")
+  parser.add_argument('--compile', action='store_true', help="run the model through torch.compile, eager if it fails")
   # genetic algorithm config
   parser.add_argument('--ngen', type=int, default=4, help="Number of generation")
   parser.add_argument('--pop', type=int, default=32, help='Population size')
   parser.add_argument('--thread', type=int, default=4, help='Number of threads')
+  parser.add_argument('--cores', type=int, default=0, help='Core budget shared by the threads and the CPT, 0 for all cores')
   parser.add_argument('--perm', type=int, default=100, help='Permutation value')
+  parser.add_argument('--perm_min', type=int, default=0, help='Permutation value of the first generation, ramped up to --perm')
+  parser.add_argument('--ckpt_dir', type=str, default="checkpoints", help='Directory of the model and GA checkpoints')
+  parser.add_argument('--ckpt_every', type=int, default=1, help='Checkpoint every n generations')
+  parser.add_argument('--resume', action='store_true', help='Resume from the last checkpoint')
   args = parser.parse_args()
 
   # load data
-  signals, labels, vfi_1, sub_id, sub_skinfold = load_raw_signals("data/subjects_40_v6.mat")
+  signals, labels, vfi_1, sub_id, sub_skinfold, offsets = load_signal_cache(DATA_CACHE, DATA_FILE)
 
-  wandb.init(project="sEMG_transformers", name=f"R{sub_id[args.sub_idx][0][0][0]}", config=args)
+  wandb.init(project="sEMG_transformers", name=f"R{sub_id[args.sub_idx]}", config=args)
   config = wandb.config
 
   np.random.seed(config.seed)
   torch.manual_seed(config.seed)
 
-  train(config, signals, labels, sub_id, sub_skinfold)
+  train(config, signals, labels, sub_id, sub_skinfold, offsets)
 
   wandb.finish()
\ No newline at end of file
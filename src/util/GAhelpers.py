@@ -0,0 +1,290 @@
+import os, sys, time, pickle, threading
+import numpy as np
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from threadpoolctl import threadpool_limits
+
+# environment variables read by BLAS/OpenMP runtimes when a (joblib) worker process starts
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                   "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+def cpu_time():
+  # CPU seconds of this process and of its child processes: the live ones (the reusable
+  # joblib/loky workers) through psutil when it is available, plus the ones already reaped
+  t = os.times()
+  total = t.user + t.system + t.children_user + t.children_system
+  try:
+    import psutil
+  except ImportError:
+    return total
+  for child in psutil.Process().children(recursive=True):
+    try:
+      c = child.cpu_times()
+      total += c.user + c.system
+    except psutil.Error:
+      pass
+  return total
+
+class CoreBudget(object):
+  """
+  Core budget of a GA run. The chromosomes are evaluated by outer threads (pymoo
+  elementwise runner), which all submit their CPT permutations to the single reusable
+  joblib (loky) worker pool of the process, so that pool is sized to all the cores
+  (n_jobs=cores) and only the BLAS/torch threads of each process are limited.
+  cores: total number of cores to use, None or 0 for all the cores on the node
+  outer: number of chromosomes evaluated concurrently
+  """
+  def __init__(self, cores=None, outer=1):
+    self.cores = cores if cores else os.cpu_count()
+    self.outer = max(1, min(outer, self.cores))
+
+    self._lock  = threading.Lock()
+    self._count = 0
+    self._start = time.perf_counter()
+    self._cpu   = cpu_time()
+
+  @contextmanager
+  def pin_threads(self, n=1):
+    # every outer thread and every CPT worker already occupies one core, so the BLAS/torch
+    # pools of this process and of the workers spawned meanwhile should not fan out any
+    # further while the GA runs, the previous limits are restored afterwards
+    env = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    torch = sys.modules.get("torch")
+    torch_threads = torch.get_num_threads() if torch is not None else None
+    for var in THREAD_ENV_VARS:
+      os.environ[var] = str(n)
+    try:
+      with threadpool_limits(limits=n):
+        if torch is not None:
+          torch.set_num_threads(n)
+        yield
+    finally:
+      for var, value in env.items():
+        if value is None:
+          os.environ.pop(var, None)
+        else:
+          os.environ[var] = value
+      if torch is not None:
+        torch.set_num_threads(torch_threads)
+
+  def pool(self):
+    return ThreadPool(self.outer)
+
+  @contextmanager
+  def track(self):
+    # counts the evaluations
+    try:
+      yield
+    finally:
+      with self._lock:
+        self._count += 1
+
+  def report(self):
+    # utilization is the CPU time of the process and its workers over wall time x cores
+    wall = time.perf_counter() - self._start
+    cpu = cpu_time() - self._cpu
+    with self._lock:
+      count = self._count
+    return {"cores"         : self.cores,
+            "outer"         : self.outer,
+            "evaluations"   : count,
+            "eval_per_sec"  : count / wall if wall > 0 else 0.0,
+            "cpu_seconds"   : cpu,
+            "utilization"   : cpu / (wall * self.cores) if wall > 0 else 0.0}
+
+def save_checkpoint(path, algorithm, cache=None, callback_data=None, config=None, fidelity=None, screen=None):
+  """
+  Write the GA state (algorithm incl. population X/F and RNG, numpy RNG state, fitness cache,
+  callback history and the state of the fidelity schedule and proxy screen) to path, together
+  with the config of the run that load_checkpoint() checks before resuming. The file is written
+  next to the target and renamed so that a crash during the write never leaves a truncated
+  checkpoint behind.
+  """
+  # the problem holds the data, the model and the thread pool, the callback holds the
+  # problem reference, both are re-attached on resume
+  problem, callback = algorithm.problem, algorithm.callback
+  algorithm.problem, algorithm.callback = None, None
+  try:
+    state = {"n_gen"     : algorithm.n_gen,
+             "X"         : algorithm.pop.get("X"),
+             "F"         : algorithm.pop.get("F"),
+             "algorithm" : pickle.dumps(algorithm),
+             "rng"       : np.random.get_state(),
+             "cache"     : dict(cache) if cache is not None else {},
+             "callback"  : callback_data,
+             "config"    : config,
+             "fidelity"  : fidelity.state_dict() if fidelity is not None else None,
+             "screen"    : screen.state_dict() if screen is not None else None}
+  finally:
+    algorithm.problem, algorithm.callback = problem, callback
+
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  tmp = f"{path}.tmp"
+  with open(tmp, "wb") as f:
+    pickle.dump(state, f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp, path)
+
+def check_config(stored, config, path):
+  # refuse to resume from a checkpoint written by a run with a different config
+  if config is None or stored == config:
+    return
+  stored = stored or {}
+  diff = sorted(k for k in set(stored) | set(config) if stored.get(k) != config.get(k))
+  raise ValueError(f"{path} was written with a different config ("
+                   + ", ".join(f"{k}: {stored.get(k)!r} != {config.get(k)!r}" for k in diff)
+                   + "), remove it or run without resuming")
+
+def load_checkpoint(path, config=None):
+  """
+  Returns the checkpointed state with the algorithm unpickled and the numpy RNG restored,
+  or None when there is no checkpoint. Raises ValueError when config is given and differs
+  from the config the checkpoint was written with. The algorithm comes back without a
+  problem, resume_algorithm() sets it up again to continue after state["n_gen"].
+  """
+  if not os.path.exists(path):
+    return None
+  with open(path, "rb") as f:
+    state = pickle.load(f)
+  check_config(state.get("config"), config, path)
+  state["algorithm"] = pickle.loads(state["algorithm"])
+  np.random.set_state(state["rng"])
+  return state
+
+def resume_algorithm(checkpoint, problem, termination, **kwargs):
+  """
+  The checkpointed algorithm set up on problem (kwargs as for pymoo.optimize.minimize(),
+  e.g. callback, verbose), ready to run the generation after checkpoint["n_gen"]. Pass it
+  to minimize() with copy_algorithm=False, which then runs it as it is.
+  """
+  algorithm = checkpoint["algorithm"]
+  # setup() reseeds the random generator of the algorithm (pymoo >= 0.6.1), the checkpointed
+  # one is put back so that the resumed run draws the same offspring as an uninterrupted one
+  rng = getattr(algorithm, "random_state", None)
+  algorithm.setup(problem, termination=termination, **kwargs)
+  if rng is not None:
+    algorithm.random_state = rng
+  # the callback checkpoints before pymoo advances the counter past the finished generation
+  algorithm.n_iter = checkpoint["n_gen"] + 1
+  return algorithm
+
+class FidelitySchedule(object):
+  """
+  Number of permutations used by the CPT objective in each generation, ramped
+  geometrically from perm_min in the first generation to perm_max in the last one.
+  perm_min = perm_max (or 0) keeps the fidelity fixed.
+  """
+  def __init__(self, perm_min, perm_max, n_gen):
+    self.perm_min = perm_min if 0 < perm_min < perm_max else perm_max
+    self.perm_max = perm_max
+    self.n_gen    = n_gen
+
+    self._lock = threading.Lock()
+    self.used  = 0
+
+  def num_perms(self, gen):
+    if self.n_gen <= 1 or self.perm_min == self.perm_max:
+      return self.perm_max
+    t = min(max(gen - 1, 0), self.n_gen - 1) / (self.n_gen - 1)
+    return int(round(self.perm_min * (self.perm_max / self.perm_min) ** t))
+
+  def spend(self, num_perms):
+    # permutations actually computed, to compare against n_eval * perm_max
+    with self._lock:
+      self.used += num_perms
+
+  def state_dict(self):
+    return {"used": self.used}
+
+  def load_state_dict(self, state):
+    self.used = state["used"]
+
+def refine_front(algorithm, problem, num_perms):
+  """
+  Re-evaluates the non-dominated chromosomes whose objectives were computed with fewer
+  than num_perms permutations, problem.objectives(x, num_perms) is expected to return
+  the cached value when it is already of high enough fidelity.
+  """
+  X = algorithm.opt.get("X")
+  F = problem.elementwise_runner(lambda x: problem.objectives(x, num_perms), X)
+  for ind, f in zip(algorithm.opt, F):
+    ind.set("F", np.asarray(f, dtype=float))
+
+def partial_correlation(x, y, z, cat_z=True):
+  # closed form partial correlation of x and y given z: correlation of the residuals after
+  # regressing both on z (one-hot encoded when z is categorical)
+  x, y, z = np.asarray(x, dtype=float), np.asarray(y, dtype=float), np.asarray(z).flatten()
+  if cat_z:
+    Z = (z[:,np.newaxis] == np.unique(z)[np.newaxis,:]).astype(float)
+  else:
+    Z = np.column_stack((np.ones(len(z)), z))
+  XY = np.column_stack((x, y))
+  R = XY - Z @ np.linalg.lstsq(Z, XY, rcond=None)[0]
+  denom = np.sqrt(np.sum(R[:,0]**2) * np.sum(R[:,1]**2))
+  return np.sum(R[:,0] * R[:,1]) / denom if denom > 0 else 0.0
+
+class ProxyScreen(object):
+  """
+  Pre-screens chromosomes on (accuracy objective, |partial correlation|) against the
+  current front before the CPT is run. A candidate dominated on the proxy is assigned the
+  worst CPT objective of its dominators instead of running the CPT, unless it is drawn for
+  auditing (with probability audit), in which case the CPT runs and the proxy verdict is
+  compared with the verdict on the true objectives to estimate the agreement rate.
+  """
+  def __init__(self, audit=0.1, random_state=None):
+    self.audit   = audit
+    self.archive = np.zeros((0,3))   # [f1, proxy, f2] of the current front
+    self.rng     = np.random.default_rng(random_state)
+
+    self._lock   = threading.Lock()
+    self.agree   = 0
+    self.checked = 0
+    self.skipped = 0
+
+  @staticmethod
+  def _dominated(A, a, b):
+    # rows of A that dominate the point (a, b) when minimizing both
+    return (A[:,0] <= a) & (A[:,1] <= b) & ((A[:,0] < a) | (A[:,1] < b))
+
+  def screen(self, f1, proxy):
+    # returns the CPT objective to assign, or None when the CPT has to be run
+    mask = self._dominated(self.archive[:,[0,1]], f1, proxy)
+    if not mask.any():
+      return None
+    with self._lock:
+      if self.rng.random() < self.audit:
+        return None
+      self.skipped += 1
+    return self.archive[mask,2].max()
+
+  def record(self, f1, proxy, f2):
+    # compare the proxy verdict with the verdict on the true objectives for an evaluated chromosome
+    by_proxy = self._dominated(self.archive[:,[0,1]], f1, proxy).any()
+    by_cpt   = self._dominated(self.archive[:,[0,2]], f1, f2).any()
+    with self._lock:
+      self.agree   += int(by_proxy == by_cpt)
+      self.checked += 1
+
+  def update(self, F, proxies):
+    self.archive = np.column_stack((F[:,0], proxies, F[:,1]))
+
+  def agreement(self):
+    with self._lock:
+      return self.agree / self.checked if self.checked else float("nan")
+
+  def state_dict(self):
+    with self._lock:
+      return {"archive" : self.archive.copy(),
+              "rng"     : self.rng.bit_generator.state,
+              "agree"   : self.agree,
+              "checked" : self.checked,
+              "skipped" : self.skipped}
+
+  def load_state_dict(self, state):
+    with self._lock:
+      self.archive = state["archive"].copy()
+      self.rng.bit_generator.state = state["rng"]
+      self.agree   = state["agree"]
+      self.checked = state["checked"]
+      self.skipped = state["skipped"]
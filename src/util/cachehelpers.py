@@ -0,0 +1,42 @@
+import os, fcntl, shutil, tempfile
+from contextlib import contextmanager
+
+@contextmanager
+def cache_lock(cache_dir):
+  """
+  Exclusive lock on cache_dir (through the file cache_dir.lock next to it), held while a
+  process checks whether the cache is current and rebuilds it, so that concurrent runs
+  convert it once. Check again after acquiring it: another process may have rebuilt the
+  cache while this one was waiting.
+  """
+  path = cache_dir.rstrip("/") + ".lock"
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  with open(path, "a") as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN)
+
+def make_tmp_dir(cache_dir, tag="tmp"):
+  # a new directory next to cache_dir (same filesystem, so that it can be renamed into place),
+  # readable by others like one made by os.makedirs() rather than private as mkdtemp() makes it
+  parent = os.path.dirname(os.path.abspath(cache_dir))
+  os.makedirs(parent, exist_ok=True)
+  tmp_dir = tempfile.mkdtemp(dir=parent, prefix=os.path.basename(cache_dir.rstrip("/")) + f".{tag}")
+  os.chmod(tmp_dir, 0o755)
+  return tmp_dir
+
+def publish_dir(tmp_dir, cache_dir):
+  """
+  Moves the finished tmp_dir to cache_dir. A previous cache is first renamed aside and removed
+  afterwards, the arrays other processes have memory-mapped from it stay valid until they
+  close them (the files are only unlinked).
+  """
+  old_dir = None
+  if os.path.exists(cache_dir):
+    old_dir = make_tmp_dir(cache_dir, "old")
+    os.replace(cache_dir, old_dir)
+  os.replace(tmp_dir, cache_dir)
+  if old_dir is not None:
+    shutil.rmtree(old_dir, ignore_errors=True)
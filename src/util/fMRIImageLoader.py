@@ -1,12 +1,14 @@
-import math
-from typing import Any
+import os, json, math, queue, shutil, threading, itertools
 import torch
+from torch import nn
 import numpy as np
-import pandas as pd
 import nibabel as nib
 from tqdm import tqdm
 from scipy.stats import norm
-from torch.utils.data import Dataset, DataLoader
+from collections import OrderedDict, deque
+from torch.utils.data import Dataset, Sampler
+from concurrent.futures import ProcessPoolExecutor
+from util.cachehelpers import cache_lock, make_tmp_dir, publish_dir
 
 def num2vect(x, bin_range, bin_step, sigma):
     """
@@ -33,35 +35,503 @@ def num2vect(x, bin_range, bin_step, sigma):
       i = i.astype(int)
       return i, bin_centers
     elif sigma > 0:
+      # the CDF at all the bin edges for all the ages in one broadcast call
+      bin_edges = bin_start + bin_step * np.arange(bin_number + 1, dtype=float)
+      cdfs = norm.cdf(bin_edges[np.newaxis,:], loc=np.reshape(x, (-1,1)), scale=sigma)
+      v = np.diff(cdfs, axis=1)
       if np.isscalar(x):
-        v = np.zeros((bin_number,))
-        for i in range(bin_number):
-          x1 = bin_centers[i] - float(bin_step) / 2
-          x2 = bin_centers[i] + float(bin_step) / 2
-          cdfs = norm.cdf([x1, x2], loc=x, scale=sigma)
-          v[i] = cdfs[1] - cdfs[0]
-        return v, bin_centers
-      else:
-        v = np.zeros((len(x), bin_number))
-        for j in range(len(x)):
-          for i in range(bin_number):
-            x1 = bin_centers[i] - float(bin_step) / 2
-            x2 = bin_centers[i] + float(bin_step) / 2
-            cdfs = norm.cdf([x1, x2], loc=x[j], scale=sigma)
-            v[j, i] = cdfs[1] - cdfs[0]
-        return v, bin_centers
+        return v[0], bin_centers
+      return v, bin_centers
+
+# soft label rows already computed, keyed by (bin_range, bin_step, sigma) and then by age
+_soft_label_table = {}
+
+def soft_labels(x, bin_range, bin_step=1, sigma=1, decimals=2):
+  """
+  Memoized num2vect() for soft labels. The ages are quantized to decimals (the resolution of
+  the AGE column in the CSV) and only the ones not seen before are computed, in one call.
+  """
+  key = (tuple(bin_range), bin_step, sigma)
+  table = _soft_label_table.setdefault(key, {})
+  ages = np.round(np.asarray(x, dtype=float).reshape(-1), decimals)
+  missing = np.array(sorted(set(ages.tolist()) - table.keys()))
+  _, bin_centers = num2vect(0, bin_range, bin_step, 0)
+  if len(missing):
+    v, _ = num2vect(missing, bin_range, bin_step, sigma)
+    table.update(zip(missing.tolist(), v))
+  return np.stack([table[a] for a in ages.tolist()]), bin_centers
+
+# storage precisions of the brain volumes, they are converted back to float32 when a sample is read
+VOLUME_DTYPES = {"float32": np.float32, "float16": np.float16, "uint8": np.uint8}
+TORCH_DTYPES  = {"float32": torch.float32, "float16": torch.float16, "uint8": torch.uint8}
+
+def shared_empty(shape, dtype="float32", shared=True):
+  # tensor allocated directly in shared memory, DataLoader workers receive a handle to it
+  # instead of their own copy. shared=False allocates it in process memory, without workers
+  # nothing else reads it (and /dev/shm is only 64MB in a default docker container)
+  tensor = torch.empty(tuple(shape), dtype=TORCH_DTYPES[dtype])
+  return tensor.share_memory_() if shared else tensor
+
+def crop_volume(image, margin=2):
+  # central (shape//8)*8 region read by CenterRandomShift plus margin voxels on every side (zero
+  # padded outside the volume). For margin < 4 the (shape//8)*8 region of the cropped volume is
+  # again the same sub-volume, so CenterRandomShift(max_shift=margin) gives the same crops on it
+  if not 0 <= margin < 4:
+    raise ValueError(f"margin must be in [0, 4), got {margin}")
+  shape = np.array(image.shape)
+  sub_shape = (shape // 8) * 8
+  start = shape // 2 - sub_shape // 2 - margin
+  size = sub_shape + 2 * margin
+  cropped = np.zeros(tuple(size), dtype=image.dtype)
+  src = tuple(slice(max(s, 0), min(s + n, d)) for s, n, d in zip(start, size, shape))
+  dst = tuple(slice(max(s, 0) - s, min(s + n, d) - s) for s, n, d in zip(start, size, shape))
+  cropped[dst] = image[src]
+  return cropped
+
+def quantize_volume(image, dtype="float32"):
+  # returns the volume in the storage dtype and the (scale, offset) mapping it back to float32,
+  # uint8 volumes are affine-quantized over their own [min, max] range
+  image = np.asarray(image, dtype=np.float32)
+  if dtype == "uint8":
+    lo, hi = float(image.min()), float(image.max())
+    scale = (hi - lo) / 255 if hi > lo else 1.0
+    q = np.rint((image - lo) / scale).astype(np.uint8)
+    return q, np.array([scale, lo], dtype=np.float32)
+  return image.astype(VOLUME_DTYPES[dtype]), np.array([1.0, 0.0], dtype=np.float32)
+
+def dequantize_volume(q, params):
+  image = torch.as_tensor(q).to(torch.float32)
+  if params[0] != 1 or params[1] != 0:
+    image = image * float(params[0]) + float(params[1])
+  return image
+
+def reconstruction_error(image, q, params):
+  # (max absolute error, sum of squared errors, sum of squared values) of one stored volume
+  err = dequantize_volume(q, params).numpy() - np.asarray(image, dtype=np.float32)
+  return float(np.abs(err).max()), float(np.sum(err.astype(np.float64)**2)), float(np.sum(np.asarray(image, dtype=np.float64)**2))
+
+def summarize_error(errors):
+  errors = np.asarray(errors).reshape(-1,3)
+  return {"max_abs"  : float(errors[:,0].max()) if len(errors) else 0.0,
+          "rel_rmse" : float(np.sqrt(errors[:,1].sum() / errors[:,2].sum())) if errors[:,2].sum() > 0 else 0.0}
+
+def volume_stats(image):
+  # (count, mean, M2, min, max) of one volume, M2 being the sum of squared deviations
+  x = np.asarray(image, dtype=np.float32).reshape(-1)
+  mean = np.sum(x, dtype=np.float64) / x.size
+  M2 = np.einsum('i,i->', x, x, dtype=np.float64) - x.size * mean**2
+  return np.array([x.size, mean, max(M2, 0.0), x.min(), x.max()], dtype=np.float64)
+
+class RunningStats(object):
+  """
+  Intensity min, max, mean and variance merged from per-volume volume_stats() as the volumes
+  are ingested (Chan et al. pairwise update), so no extra pass over the images is needed.
+  """
+  def __init__(self):
+    self.count = 0
+    self.mean  = 0.0
+    self.M2    = 0.0
+    self.min   = float("inf")
+    self.max   = float("-inf")
+
+  def update(self, stats):
+    stats = np.asarray(stats, dtype=np.float64).reshape(-1,5)
+    n = stats[:,0].sum()
+    if n == 0:
+      return self
+    mean = np.sum(stats[:,0] * stats[:,1]) / n
+    M2 = np.sum(stats[:,2] + stats[:,0] * (stats[:,1] - mean)**2)
+    total = self.count + n
+    delta = mean - self.mean
+    self.mean  = float(self.mean + delta * n / total)
+    self.M2    = float(self.M2 + M2 + delta**2 * self.count * n / total)
+    self.count = int(total)
+    self.min   = min(self.min, float(stats[:,3].min()))
+    self.max   = max(self.max, float(stats[:,4].max()))
+    return self
+
+  @property
+  def std(self):
+    return math.sqrt(self.M2 / self.count) if self.count else 0.0
+
+  def to_dict(self):
+    return {"min": self.min, "max": self.max, "mean": self.mean, "std": self.std}
+
+  def __repr__(self):
+    return f"Min={self.min}, Max={self.max}, Mean={self.mean}, Std={self.std}"
+
+class VolumeCache(object):
+  """
+  Bounded LRU cache of decoded volumes in front of load(idx). Indices queued with prefetch()
+  are decoded ahead of their use by a background thread. An index is decoded by one thread at
+  a time, a get() of an index the prefetch is decoding waits for its result.
+  """
+  def __init__(self, load, capacity=64):
+    self.load     = load
+    self.capacity = capacity
+    self.hits     = 0
+    self.misses   = 0
+    self._setup()
+
+  def _setup(self):
+    self._cache   = OrderedDict()
+    self._lock    = threading.Lock()
+    self._loading = {}
+    self._queue   = queue.Queue()
+    self._thread  = None
+
+  # the thread, lock and cached volumes are not carried over into DataLoader worker processes
+  def __getstate__(self):
+    return {"load": self.load, "capacity": self.capacity, "hits": 0, "misses": 0}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._setup()
+
+  def get(self, idx):
+    while True:
+      with self._lock:
+        if idx in self._cache:
+          self._cache.move_to_end(idx)
+          self.hits += 1
+          return self._cache[idx]
+        loading = self._loading.get(idx)
+        if loading is None:
+          self.misses += 1
+          loading = self._loading[idx] = threading.Event()
+          break
+      # decoded by the prefetch thread right now
+      loading.wait()
+    return self._load(idx, loading)
+
+  def _load(self, idx, loading):
+    # decode idx claimed by the caller in _loading, waiters are released even if load fails
+    try:
+      image = self.load(idx)
+      self._put(idx, image)
+    finally:
+      with self._lock:
+        del self._loading[idx]
+      loading.set()
+    return image
+
+  def _put(self, idx, image):
+    with self._lock:
+      self._cache[idx] = image
+      self._cache.move_to_end(idx)
+      while len(self._cache) > self.capacity:
+        self._cache.popitem(last=False)
+
+  def prefetch(self, indices):
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._prefetch, daemon=True)
+      self._thread.start()
+    for idx in indices:
+      self._queue.put(idx)
+
+  def _prefetch(self):
+    while True:
+      idx = self._queue.get()
+      with self._lock:
+        if idx in self._cache or idx in self._loading:
+          continue
+        loading = self._loading[idx] = threading.Event()
+      try:
+        self._load(idx, loading)
+      except Exception as e:
+        # left to the get() of idx, which loads it again and raises
+        print(f"Prefetch of volume {idx} failed: {e}")
+
+class PrefetchSampler(Sampler):
+  # yields the indices of the wrapped sampler while keeping the next depth of them queued
+  # for prefetching, the prefetch thread lives in the process that iterates the sampler
+  # (the main process), so it only helps with num_workers=0: the workers decode into their
+  # own copies of the cache
+  def __init__(self, sampler, cache, depth=8):
+    self.sampler = sampler
+    self.cache   = cache
+    self.depth   = depth
+
+  def __iter__(self):
+    indices = iter(self.sampler)
+    window = deque(itertools.islice(indices, self.depth))
+    self.cache.prefetch(list(window))
+    while window:
+      idx = window.popleft()
+      for nxt in itertools.islice(indices, 1):
+        window.append(nxt)
+        self.cache.prefetch([nxt])
+      yield idx
+
+  def __len__(self):
+    return len(self.sampler)
+
+class IXIDataset(Dataset):
+  # store - optional VolumeStore, when given the images are read from its memory-mapped
+  #         volumes (shared by all the splits) instead of being decoded and preloaded here
+  # dtype - precision of the preloaded images, "float32", "float16" or "uint8" (the store
+  #         keeps the dtype it was built with)
+  # margin - when set, only the CenterRandomShift region plus margin voxels is preloaded
+  # lazy - nothing is preloaded, volumes are read on demand (from the store or the NIfTI files)
+  #        through a VolumeCache of cache_size volumes, see PrefetchSampler
+  # normalize - standardize the intensities with the statistics of this split (True) or with
+  #             given RunningStats (e.g. those of the training split)
+  # shared - preload into shared memory for DataLoader workers, process memory when False
+  def __init__(self, data_dir, data_df, bin_range=None, transform=None, store=None, dtype="float32", margin=None,
+               lazy=False, cache_size=64, normalize=None, shared=True):
+    self.directory = data_dir
+    self.store = store
+    self.dtype = dtype
+    self.margin = margin
+    self.lazy = lazy
+    self.info = data_df
+    self.info = self.info.reset_index(drop=True)
+    self.transform = transform
+
+    if not bin_range:
+      self.bin_range = [math.floor(self.info['AGE'].min()), math.ceil(self.info['AGE'].max())]
+      print(f"Age min {self.info['AGE'].min()}, Age max {self.info['AGE'].max()}")
+      print("Computed Bin Range: ", self.bin_range)
+    else:
+      self.bin_range  = bin_range
+      print(f"Provided Bin Range: {self.bin_range}")
+
+    # Count the number of images from each site
+    site_counts = self.info['SITE'].value_counts()
+    print("Count of entries by SITE:")
+    print(site_counts)
+
+    total_count = site_counts.sum()
+    print(f"\nTotal count for selected sites: {total_count}")
+
+    y, bc = soft_labels(self.info["AGE"].to_numpy(), self.bin_range, 1, 1)
+    self.label_all = torch.tensor(y + 1e-16, dtype=torch.float32)
+
+    # intensity statistics of the split, merged from the per-volume statistics of the store or
+    # gathered while preloading (not available for lazy reads from the NIfTI files)
+    self.stats = None
+    if self.store is not None:
+      self.rows = self.store.rows(self.info["FILENAME"])
+      self.stats = self.store.split_stats(self.rows)
+      print(f"Voxel Size: {self.store.voxel_size}")
+    elif self.lazy:
+      nii = nib.load(self.directory+"/"+self.info["FILENAME"][0])
+      print(f"Voxel Size: {nii.header.get_zooms()}")
+    else:
+      # Pre-load the images (if RAM is allowing) into shared memory, stored in self.dtype and
+      # dequantized per sample
+      print(self.info["FILENAME"][0])
+      nii = nib.load(self.directory+"/"+self.info["FILENAME"][0])
+      voxel_size = nii.header.get_zooms()
+      print(f"Voxel Size: {voxel_size}")
+      shape = crop_volume(np.empty(nii.shape, dtype=np.uint8), self.margin).shape if self.margin is not None else nii.shape
+      self.image_all = shared_empty((len(self.info),) + tuple(shape), self.dtype, shared)
+      self.params = np.empty((len(self.info), 2), dtype=np.float32)
+      image_all = self.image_all.numpy()
+      errors = []
+      self.stats = RunningStats()
+      for i in tqdm(range(len(self.info)), desc="Loading Data"):
+        nii = nib.load(self.directory+"/"+self.info["FILENAME"][i])
+        image = nii.get_fdata(dtype=np.float32)
+        if self.margin is not None:
+          image = crop_volume(image, self.margin)
+        image_all[i], self.params[i] = quantize_volume(image, self.dtype)
+        errors.append(reconstruction_error(image, image_all[i], self.params[i]))
+        self.stats.update(volume_stats(image))
+      self.error = summarize_error(errors)
+
+    if normalize is True:
+      normalize = self.stats
+      if normalize is None:
+        raise ValueError("normalize=True needs the statistics of a volume store or of preloaded volumes")
+    self.norm = (normalize.mean, normalize.std) if normalize else None
+
+    self.bin_center = torch.tensor(bc, dtype=torch.float32)
+    self.cache = VolumeCache(self.load_volume, cache_size) if self.lazy else None
+
+    if self.store is not None:
+      print(f"Image Dim {(len(self.rows),) + self.store.shape}")
+      print(f"Label Dim {self.label_all.shape}")
+      print(f"Reconstruction Error ({self.store.dtype}): {self.store.error}")
+      print(self.stats)
+    elif self.lazy:
+      print(f"Image Dim {(len(self.info),) + tuple(self.load_volume(0).shape)} (lazy, cache of {cache_size})")
+      print(f"Label Dim {self.label_all.shape}")
+    else:
+      print(f"Image Dim {self.image_all.shape}")
+      print(f"Label Dim {self.label_all.shape}")
+      print(f"Image Memory: {self.image_all.element_size() * self.image_all.nelement() / 2**20:.1f} MiB ({self.dtype})")
+      print(f"Reconstruction Error ({self.dtype}): {self.error}")
+      print(self.stats)
+    if self.norm is not None:
+      print(f"Normalized with Mean={self.norm[0]}, Std={self.norm[1]}")
+
+  def __len__(self):
+    return len(self.info)
+
+  def load_volume(self, idx):
+    if self.store is not None:
+      return self.store.read(self.rows[idx])
+    image = nib.load(self.directory+"/"+self.info["FILENAME"][idx]).get_fdata(dtype=np.float32)
+    if self.margin is not None:
+      image = crop_volume(image, self.margin)
+    return torch.from_numpy(image)
+
+  def __getitem__(self, idx):
+    if self.lazy:
+      image, label = self.cache.get(idx), self.label_all[idx,:]
+    elif self.store is not None:
+      image, label = self.store.read(self.rows[idx]), self.label_all[idx,:]
+    else:
+      image, label = dequantize_volume(self.image_all[idx,:], self.params[idx]), self.label_all[idx,:]
+    if self.norm is not None:
+      image = (image - self.norm[0]) / self.norm[1]
+    if self.transform:
+      for tsfrm in self.transform:
+        image = tsfrm(image)
+    image = torch.unsqueeze(image, 0)
+    return image, label
+
+def _ingest_volume(args):
+  # runs in a worker process: decode one NIfTI file and write it into its row of the store
+  path, store_dir, row, dtype, margin = args
+  volumes = np.load(os.path.join(store_dir, "volumes.npy"), mmap_mode="r+")
+  params  = np.load(os.path.join(store_dir, "params.npy"),  mmap_mode="r+")
+  image = nib.load(path).get_fdata(dtype=np.float32)
+  if margin is not None:
+    image = crop_volume(image, margin)
+  volumes[row], params[row] = quantize_volume(image, dtype)
+  volumes.flush()
+  params.flush()
+  return reconstruction_error(image, volumes[row], params[row]), volume_stats(image)
+
+def build_volume_store(data_dir, filenames, store_dir, num_workers=None, dtype="float32", margin=None):
+  """
+  One-time ingest of NIfTI volumes into a single memory-mapped array. The files are decoded
+  in parallel by a process pool, each worker writing directly into its row of
+  store_dir/volumes.npy (in dtype, with the per-volume dequantization in store_dir/params.npy),
+  and store_dir/index.json maps every filename to its row. With margin set only the
+  crop_volume() region is stored. The volume_stats() of every row are kept in
+  store_dir/stats.npy, from which the statistics of any split are merged without a pass.
+  """
+  filenames = list(dict.fromkeys(filenames))
+  nii = nib.load(os.path.join(data_dir, filenames[0]))
+  shape = crop_volume(np.empty(nii.shape, dtype=np.uint8), margin).shape if margin is not None else nii.shape
+
+  # written to a directory of its own first so that an interrupted ingest is never picked up
+  tmp_dir = make_tmp_dir(store_dir)
+  try:
+    _write_volume_store(tmp_dir, data_dir, filenames, shape, nii, num_workers, dtype, margin)
+  except BaseException:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    raise
+  publish_dir(tmp_dir, store_dir)
+
+def _write_volume_store(tmp_dir, data_dir, filenames, shape, nii, num_workers, dtype, margin):
+  np.lib.format.open_memmap(os.path.join(tmp_dir, "volumes.npy"), mode="w+", dtype=VOLUME_DTYPES[dtype], shape=(len(filenames),) + tuple(shape))
+  np.lib.format.open_memmap(os.path.join(tmp_dir, "params.npy"),  mode="w+", dtype=np.float32, shape=(len(filenames), 2))
+
+  jobs = [(os.path.join(data_dir, f), tmp_dir, i, dtype, margin) for i, f in enumerate(filenames)]
+  with ProcessPoolExecutor(num_workers) as pool:
+    errors, stats = zip(*tqdm(pool.map(_ingest_volume, jobs, chunksize=4), total=len(jobs), desc="Ingesting Data"))
+
+  np.save(os.path.join(tmp_dir, "stats.npy"), np.stack(stats))
+  error = summarize_error(errors)
+  stats = RunningStats().update(stats)
+  print(f"Reconstruction Error ({dtype}): {error}")
+  print(stats)
+  with open(os.path.join(tmp_dir, "index.json"), "w") as f:
+    json.dump({"filenames"  : filenames,
+               "shape"      : list(shape),
+               "voxel_size" : [float(v) for v in nii.header.get_zooms()],
+               "dtype"      : dtype,
+               "margin"     : margin,
+               "error"      : error,
+               "stats"      : stats.to_dict()}, f)
+
+class VolumeStore(object):
+  def __init__(self, store_dir):
+    self.store_dir = store_dir
+    with open(os.path.join(store_dir, "index.json")) as f:
+      meta = json.load(f)
+    self.filenames  = meta["filenames"]
+    self.shape      = tuple(meta["shape"])
+    self.voxel_size = tuple(meta["voxel_size"])
+    self.dtype      = meta["dtype"]
+    self.margin     = meta["margin"]
+    self.error      = meta["error"]
+    self.index      = {filename: row for row, filename in enumerate(self.filenames)}
+    self.volumes    = np.load(os.path.join(store_dir, "volumes.npy"), mmap_mode="r")
+    self.params     = np.load(os.path.join(store_dir, "params.npy"))
+    self.stats      = np.load(os.path.join(store_dir, "stats.npy"))
+    self.shared     = None
+
+  # pickled into DataLoader workers without the memory map, which is reopened on the other side
+  # (the shared tensor travels as a shared memory handle)
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state["volumes"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.volumes = np.load(os.path.join(self.store_dir, "volumes.npy"), mmap_mode="r")
+
+  def share(self, chunk=64, shared=True):
+    # copies the volumes once into a shared memory tensor that all the splits, loaders and
+    # workers index by row, filled in chunks to avoid a second full copy in process memory
+    # (shared=False keeps the copy in process memory when there are no workers)
+    if self.shared is None:
+      self.shared = shared_empty((len(self),) + self.shape, self.dtype, shared)
+      for i in tqdm(range(0, len(self), chunk), desc="Sharing Data"):
+        self.shared[i:i+chunk] = torch.from_numpy(np.array(self.volumes[i:i+chunk]))
+    return self
+
+  def __len__(self):
+    return len(self.filenames)
+
+  def rows(self, filenames):
+    return np.array([self.index[f] for f in filenames], dtype=np.int64)
+
+  def split_stats(self, rows):
+    return RunningStats().update(self.stats[rows])
+
+  def read(self, row):
+    if self.shared is not None:
+      return dequantize_volume(self.shared[row], self.params[row])
+    return dequantize_volume(np.array(self.volumes[row]), self.params[row])
+
+def volume_store_is_current(store_dir, dtype="float32", margin=None):
+  # an existing store is rebuilt when it was ingested with another dtype or crop margin
+  try:
+    with open(os.path.join(store_dir, "index.json")) as f:
+      meta = json.load(f)
+  except (OSError, ValueError):
+    return False
+  return meta.get("dtype") == dtype and meta.get("margin") == margin and "stats" in meta
+
+def open_volume_store(store_dir, data_dir, filenames, num_workers=None, dtype="float32", margin=None):
+  if not volume_store_is_current(store_dir, dtype, margin):
+    with cache_lock(store_dir):
+      # built by another process while this one waited for the lock
+      if not volume_store_is_current(store_dir, dtype, margin):
+        build_volume_store(data_dir, filenames, store_dir, num_workers, dtype, margin)
+  return VolumeStore(store_dir)
 
 # NOTE All transform functions assume that input images are torch tensors
 class CenterRandomShift(object):
-  def __init__(self, randshift=None):
+  # max_shift - the center is shifted by up to max_shift voxels along every axis, volumes
+  #             stored with crop_volume(margin=max_shift) hold exactly the reachable region
+  def __init__(self, randshift=None, max_shift=2):
     self.shift = randshift
+    self.max_shift = max_shift
 
   def __call__(self, image):
     image_shape = torch.tensor(image.shape)
     center = image_shape // 2
     sub_shape = (image_shape // 8) * 8
     if self.shift:
-      shift = torch.randint(-2,3,size=(3,))
+      shift = torch.randint(-self.max_shift,self.max_shift+1,size=(3,))
       center = center + shift
     start = center - sub_shape // 2
     end = start + sub_shape
@@ -77,3 +547,36 @@ class RandomMirror(object):
       return image.flip(self.dim)
     else:
       return image
+
+# Batch versions of the transforms above, applied to a collated [B,C,D,H,W] batch (on any
+# device) with the random draws of all the samples made at once
+class BatchCenterRandomShift(nn.Module):
+  def __init__(self, randshift=None, max_shift=2):
+    super().__init__()
+    self.shift = randshift
+    self.max_shift = max_shift
+
+  def forward(self, images):
+    B, device = images.shape[0], images.device
+    image_shape = torch.tensor(images.shape[2:], device=device)
+    sub_shape = (image_shape // 8) * 8
+    start = (image_shape // 2 - sub_shape // 2).expand(B, 3)
+    if self.shift:
+      start = start + torch.randint(-self.max_shift, self.max_shift+1, size=(B,3), device=device)
+    # one gather of the per-sample crops through broadcast voxel indices
+    d, h, w = (start[:,i,None] + torch.arange(int(sub_shape[i]), device=device) for i in range(3))
+    b = torch.arange(B, device=device)
+    crops = images.permute(0,2,3,4,1)[b[:,None,None,None], d[:,:,None,None], h[:,None,:,None], w[:,None,None,:]]
+    return crops.permute(0,4,1,2,3)
+
+class BatchRandomMirror(nn.Module):
+  # dim is the spatial dimension of the volume, as for RandomMirror
+  def __init__(self, dim=0, p=0.5):
+    super().__init__()
+    self.dim = dim
+    self.p   = p
+
+  def forward(self, images):
+    mask = torch.rand(images.shape[0], device=images.device) > self.p
+    return torch.where(mask[:,None,None,None,None], images.flip(self.dim+2), images)
+
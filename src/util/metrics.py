@@ -0,0 +1,32 @@
+import torch
+
+def count_correct(outputs, targets):
+  # correct predictions of logits against one-hot targets, as a tensor on their device
+  # (the argmax of the logits is the argmax of their softmax)
+  return (outputs.argmax(dim=1) == targets.argmax(dim=1)).sum()
+
+class MetricSums(object):
+  """
+  Per-epoch sums of batch metrics (losses, correct counts, MAEs) accumulated as float32 tensors
+  on the device of the values, so that the training loops do not wait for the device on every
+  batch. read() copies the sums to the host in a single transfer, once per epoch.
+  """
+  def __init__(self):
+    self.sums = {}
+
+  def add(self, **values):
+    for name, value in values.items():
+      value = value.detach().float()
+      if name in self.sums:
+        self.sums[name] += value
+      else:
+        self.sums[name] = value.clone()
+
+  def read(self, *names):
+    # the sums of names as python floats, 0.0 for a metric that was never added
+    sums = [self.sums[name] for name in names if name in self.sums]
+    values = iter(torch.stack(sums).tolist() if sums else [])
+    return [next(values) if name in self.sums else 0.0 for name in names]
+
+  def __repr__(self):
+    return f"MetricSums({', '.join(self.sums)})"
@@ -1,44 +1,51 @@
 import torch
 import numpy as np
 import scipy.io as sio
-from torch.utils.data import Dataset
-
-class sEMGFeatureDataset(Dataset):
-  def __init__(self, Feature,Label, transform=None, verbose=False):
-    self.transform = transform
-    self.feature = Feature
-    self.label   = Label
-  
-  def __len__(self):
-      return np.shape(self.label)[0]
-  
-  def __getitem__(self, idx):
-    if torch.is_tensor(idx):
-      idx = idx.tolist()
-    
-    if self.label[idx] == 1:
-      label = np.array([0, 1])
-    elif self.label[idx] == -1:
-      label = np.array([1, 0])
-    
-    feature = torch.tensor(self.feature[idx,:], dtype=torch.float32)
-    label   = torch.tensor(label, dtype=torch.float32)
-    sample = {'feature': feature, "label": label}
-    
-    return sample
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
 
 class sEMGSignalDataset(Dataset):
-  def __init__(self, signals, labels):
+  # signals - [N,C,L] numpy/memory-mapped array, or a float32 torch tensor (e.g. from
+  #           to_shared_tensor, normalized there) from which samples and batches are sliced
+  #           without conversion
+  # indices - rows of signals/labels that belong to this split (e.g. from loso_split),
+  #           all rows when not given
+  # idx can be a single index or a list of indices, the latter is what batch_loader() passes
+  # so that a whole batch is one slicing operation instead of B __getitem__ calls and a collate
+  def __init__(self, signals, labels, indices=None):
     self.signals = signals
-    self.labels = labels
+    self.labels = torch.tensor(np.asarray(labels), dtype=torch.float32)
+    self.indices = np.arange(len(labels)) if indices is None else np.asarray(indices)
 
   def __len__(self):
-    return len(self.labels)
+    return len(self.indices)
 
   def __getitem__(self, idx):
-    signal = torch.tensor(self.signals[idx,:,:], dtype=torch.float32)
-    label = torch.tensor(self.labels[idx,:], dtype=torch.float32)
-    return signal, label
+    row = self.indices[idx]
+    if torch.is_tensor(self.signals):
+      signal = self.signals[torch.as_tensor(row)]
+    else:
+      signal = torch.tensor(self.signals[row], dtype=torch.float32)
+    return signal, self.labels[torch.as_tensor(row)]
+
+def to_shared_tensor(signals, mean=None, std=None, chunk=4096, shared=True):
+  # float32 copy of the signals in shared memory so DataLoader workers do not duplicate it,
+  # filled chunk by chunk and normalized in place to avoid full-size temporaries. shared=False
+  # keeps it in process memory for loaders without workers (/dev/shm is only 64MB in a default
+  # docker container)
+  X = torch.empty(signals.shape, dtype=torch.float32)
+  if shared:
+    X.share_memory_()
+  for start in range(0, len(signals), chunk):
+    X[start:start+chunk] = torch.tensor(signals[start:start+chunk], dtype=torch.float32)
+  if mean is not None:
+    X.sub_(torch.tensor(np.asarray(mean), dtype=torch.float32)[:,None])
+    X.div_(torch.tensor(np.asarray(std),  dtype=torch.float32)[:,None])
+  return X
+
+def batch_loader(dataset, batch_size, shuffle=False, **kwargs):
+  # serves whole batches through dataset[list_of_indices], automatic batching is disabled
+  sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+  return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False), batch_size=None, **kwargs)
 
 if __name__ == "__main__":
   data_all = sio.loadmat("data/subjects_40_v6.mat")
@@ -1,5 +1,7 @@
+import os, json, shutil, argparse
 import numpy as np
 import scipy.io as sio
+from util.cachehelpers import cache_lock, make_tmp_dir, publish_dir
 
 def partition_features(FEAT, LABEL, SUBJECT_SKINFOLD, sub_test, SUBJECT_ID=None):
   # Load testing samples
@@ -9,25 +11,13 @@ def partition_features(FEAT, LABEL, SUBJECT_SKINFOLD, sub_test, SUBJECT_ID=None)
   if SUBJECT_ID is not None: ID_Test = SUBJECT_ID[sub_test,0].flatten()
   print(f'# of Testing Samples {len(Y_Test)}')
 
-  # Load training samples
-  X_Train = np.zeros((0,48))
-  Y_Train = np.zeros(0)    
-  C_Train = np.zeros(0)
-  if SUBJECT_ID is not None: ID_Train = np.zeros(0)
-  for sub_train in range(40):
-    if sub_train != sub_test:
-      x_s = FEAT[sub_train,0]
-      X_Train = np.concatenate((X_Train, x_s), axis=0)
-
-      y_s = LABEL[sub_train,0].flatten()
-      Y_Train = np.concatenate((Y_Train, y_s), axis=0)
-
-      c_s = np.mean(np.mean(SUBJECT_SKINFOLD[sub_train,:]), axis=1)
-      C_Train = np.concatenate((C_Train, c_s), axis=0)
-
-      if SUBJECT_ID is not None:
-        id_s = SUBJECT_ID[sub_train,0].flatten()
-        ID_Train = np.concatenate((ID_Train, id_s), axis=0)
+  # Load training samples, concatenated once instead of growing the arrays subject by subject
+  train_subs = [sub_train for sub_train in range(40) if sub_train != sub_test]
+  X_Train = np.concatenate([FEAT[sub_train,0] for sub_train in train_subs], axis=0).astype(np.float64, copy=False)
+  Y_Train = np.concatenate([LABEL[sub_train,0].flatten() for sub_train in train_subs]).astype(np.float64, copy=False)
+  C_Train = np.concatenate([np.mean(np.mean(SUBJECT_SKINFOLD[sub_train,:]), axis=1) for sub_train in train_subs]).astype(np.float64, copy=False)
+  if SUBJECT_ID is not None:
+    ID_Train = np.concatenate([SUBJECT_ID[sub_train,0].flatten() for sub_train in train_subs]).astype(np.float64, copy=False)
 
   print('# of Healthy Samples: %d'%(np.sum(Y_Train == -1)))
   print('# of Fatigued Samples: %d'%(np.sum(Y_Train == 1)))
@@ -37,6 +27,60 @@ def partition_features(FEAT, LABEL, SUBJECT_SKINFOLD, sub_test, SUBJECT_ID=None)
   else:
     return X_Train, Y_Train, C_Train, X_Test, Y_Test, C_Test
 
+# partition_features over the arrays of the feature cache (see load_feature_cache): the same
+# training and testing rows in the same subject order, sliced at the subject offsets
+def partition_feature_cache(features, labels, skinfold, offsets, sub_test):
+  test = slice(offsets[sub_test], offsets[sub_test+1])
+  train = np.concatenate((np.arange(offsets[0], offsets[sub_test]), np.arange(offsets[sub_test+1], offsets[-1])))
+  X_Test = np.asarray(features[test])
+  Y_Test = np.asarray(labels[test])
+  C_Test = np.mean(skinfold[test], axis=1)
+  print(f'# of Testing Samples {len(Y_Test)}')
+
+  X_Train = features[train].astype(np.float64, copy=False)
+  Y_Train = labels[train].astype(np.float64)
+  C_Train = np.mean(skinfold[train], axis=1, dtype=np.float64)
+
+  print('# of Healthy Samples: %d'%(np.sum(Y_Train == -1)))
+  print('# of Fatigued Samples: %d'%(np.sum(Y_Train == 1)))
+  return X_Train, Y_Train, C_Train, X_Test, Y_Test, C_Test
+
+# Leave-one-subject-out split over the subject offsets of the signal cache. Only row indices are
+# returned, the same rows as concatenating the other subjects and shuffling them with the global
+# numpy RNG, so the datasets can index the cached arrays without copying them.
+# sub_test = None keeps every subject for training/validation and returns an empty test set.
+def loso_split(offsets, sub_test=None, train_size=0.9):
+  if sub_test is None:
+    rows = np.arange(offsets[-1])
+    test_idx = np.arange(0)
+  else:
+    rows = np.concatenate((np.arange(offsets[0], offsets[sub_test]), np.arange(offsets[sub_test+1], offsets[-1])))
+    test_idx = np.arange(offsets[sub_test], offsets[sub_test+1])
+
+  num_samples = len(rows)
+  indices = np.arange(num_samples)
+  np.random.shuffle(indices)
+  split_idx = int(num_samples*train_size)
+  return rows[indices[:split_idx]], rows[indices[split_idx:]], test_idx
+
+# Channel-wise mean and std of [N,C,L] arrays (e.g. the per-subject views of the signal cache) in
+# a single pass: sums and sums of squares are accumulated per array in float64 and merged with the
+# parallel Welford update, so neither a concatenated copy nor a normalized copy is needed.
+def channel_stats(arrays):
+  count, mean, M2 = 0, 0.0, 0.0
+  for x in arrays:
+    n = x.shape[0] * x.shape[2]
+    if n == 0:
+      continue
+    x_mean = np.sum(x, axis=(0,2), dtype=np.float64) / n
+    x_M2 = np.einsum('ncl,ncl->c', x, x, dtype=np.float64) - n * x_mean**2
+    delta = x_mean - mean
+    total = count + n
+    mean = mean + delta * n / total
+    M2 = M2 + x_M2 + delta**2 * count * n / total
+    count = total
+  return mean, np.sqrt(M2 / count)
+
 # mainly just for the sake of not keeping the copy of DATA_ALL
 def load_features(file):
   DATA_ALL = sio.loadmat(file)
@@ -54,4 +98,100 @@ def load_raw_signals(file):
   VFI1 = data['SUBJECT_VFI']       # VFI-1 Score
   sub_id = data['SUBJECT_ID']        # Sujbect ID
   sub_skinfold = data['SUBJECT_SKINFOLD']  # Subject Skinfold Thickness
-  return signals, labels, VFI1, sub_id, sub_skinfold
\ No newline at end of file
+  return signals, labels, VFI1, sub_id, sub_skinfold
+
+# mtime and size of the source .mat, stored with the cache so that a cache converted from another
+# version of the file is rebuilt
+def source_stamp(file):
+  st = os.stat(file)
+  return {"mtime": st.st_mtime, "size": st.st_size}
+
+# One-time conversion of the MATLAB cell arrays into contiguous float32 .npy files that can be
+# memory-mapped. Samples of all subjects are stored back to back, subject i owning the rows
+# offsets[i]:offsets[i+1] of signals [N,C,L], labels [N], skinfold [N,K] and, when the file has
+# them, of the normalized features [N,F] (kept in their own precision). sub_id and vfi_1 hold one
+# value per subject.
+def convert_raw_signals(file, cache_dir):
+  data = sio.loadmat(file)
+  signals, labels, vfi_1, sub_id, sub_skinfold = (data[key] for key in ("DATA", "LABEL", "SUBJECT_VFI", "SUBJECT_ID", "SUBJECT_SKINFOLD"))
+  num_sub = signals.shape[0]
+  counts  = [labels[i][0].shape[0] for i in range(num_sub)]
+  offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+  # written to a directory of its own first so that an interrupted conversion is never picked up
+  tmp_dir = make_tmp_dir(cache_dir)
+  try:
+    _write_cache(tmp_dir, file, data, signals, labels, vfi_1, sub_id, sub_skinfold, offsets)
+  except BaseException:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    raise
+  publish_dir(tmp_dir, cache_dir)
+
+def _write_cache(tmp_dir, file, data, signals, labels, vfi_1, sub_id, sub_skinfold, offsets):
+  num_sub = len(offsets) - 1
+  x = np.stack(signals[0], axis=1)
+  X = np.lib.format.open_memmap(os.path.join(tmp_dir, "signals.npy"), mode="w+", dtype=np.float32,
+                                shape=(offsets[-1],) + x.shape[1:])
+  for i in range(num_sub):
+    # stack all inputs into [N,C,L] format
+    X[offsets[i]:offsets[i+1]] = np.stack(signals[i], axis=1)
+  X.flush()
+  del X
+
+  np.save(os.path.join(tmp_dir, "labels.npy"),   np.concatenate([labels[i][0].flatten() for i in range(num_sub)]).astype(np.float32))
+  np.save(os.path.join(tmp_dir, "skinfold.npy"), np.concatenate([sub_skinfold[i][0] for i in range(num_sub)]).astype(np.float32))
+  np.save(os.path.join(tmp_dir, "sub_id.npy"),   np.array([sub_id[i][0].flatten()[0] for i in range(num_sub)]))
+  np.save(os.path.join(tmp_dir, "vfi_1.npy"),    np.array([vfi_1[i][0].flatten()[0] for i in range(num_sub)]))
+  np.save(os.path.join(tmp_dir, "offsets.npy"),  offsets)
+  if "FEAT_N" in data:
+    features = np.concatenate([data["FEAT_N"][i][0] for i in range(num_sub)], axis=0)
+    if len(features) != offsets[-1]:
+      raise ValueError(f"FEAT_N of {file} has {len(features)} samples, LABEL has {offsets[-1]}")
+    np.save(os.path.join(tmp_dir, "features.npy"), features)
+  with open(os.path.join(tmp_dir, "source.json"), "w") as f:
+    json.dump(source_stamp(file), f)
+
+# A cache holding the arrays of names is up to date when it was converted from the current
+# version of file (or file is not available)
+def cache_is_current(cache_dir, file=None, names=("offsets",)):
+  if not all(os.path.exists(os.path.join(cache_dir, name+".npy")) for name in names):
+    return False
+  if file is None or not os.path.exists(file):
+    return True
+  try:
+    with open(os.path.join(cache_dir, "source.json")) as f:
+      return json.load(f) == source_stamp(file)
+  except (OSError, ValueError):
+    return False
+
+def _open_cache(cache_dir, file, names):
+  if not cache_is_current(cache_dir, file, names):
+    with cache_lock(cache_dir):
+      # converted by another process while this one waited for the lock
+      if not cache_is_current(cache_dir, file, names):
+        print(f"Converting {file} into {cache_dir}")
+        convert_raw_signals(file, cache_dir)
+  def load(name):
+    return np.load(os.path.join(cache_dir, name+".npy"), mmap_mode="r")
+  return load
+
+# Opens the converted arrays as read-only memmaps, the conversion is done on first use and
+# repeated when file changed
+def load_signal_cache(cache_dir, file=None):
+  load = _open_cache(cache_dir, file, ("offsets",))
+  return load("signals"), load("labels"), load("vfi_1"), load("sub_id"), load("skinfold"), load("offsets")
+
+# Same cache with the normalized features in place of the raw signals, see partition_feature_cache
+def load_feature_cache(cache_dir, file=None):
+  load = _open_cache(cache_dir, file, ("offsets", "features"))
+  if not os.path.exists(os.path.join(cache_dir, "features.npy")):
+    raise ValueError(f"{file} has no FEAT_N features")
+  return load("features"), load("labels"), load("vfi_1"), load("sub_id"), load("skinfold"), load("offsets")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Convert the sEMG .mat file into a memory-mapped cache")
+  parser.add_argument("--file", type=str, default="data/subjects_40_v6.mat", help="MATLAB data file")
+  parser.add_argument("--cache_dir", type=str, default="data/subjects_40_v6", help="output directory")
+  args = parser.parse_args()
+  with cache_lock(args.cache_dir):
+    convert_raw_signals(args.file, args.cache_dir)
@@ -0,0 +1,139 @@
+import time, torch
+import torch.nn.functional as F
+from torch import nn
+
+class SDPAEncoderLayer(nn.TransformerEncoderLayer):
+  """
+  nn.TransformerEncoderLayer (same parameters and state dict) whose self-attention block
+  always runs through F.scaled_dot_product_attention, so the fused flash / memory efficient
+  kernels are used whenever the device supports them. Expects batch_first=True.
+  """
+  def _sa_block(self, x, attn_mask, key_padding_mask, is_causal=False):
+    if attn_mask is not None or key_padding_mask is not None:
+      return super()._sa_block(x, attn_mask, key_padding_mask, is_causal=is_causal)
+    attn = self.self_attn
+    B, L, D = x.shape
+    H = attn.num_heads
+    q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).view(B, L, 3, H, D//H).permute(2, 0, 3, 1, 4)
+    x = F.scaled_dot_product_attention(q, k, v, dropout_p=attn.dropout if self.training else 0.0, is_causal=is_causal)
+    x = attn.out_proj(x.transpose(1, 2).reshape(B, L, D))
+    return self.dropout1(x)
+
+class sEMGtransformer(nn.Module):
+  """
+  Transformer over the non-overlapping patches of a [B, C, window] sEMG signal.
+  window: number of samples the positional embedding covers (seq_len = window // patch_size)
+  pool  : "cls" for the class token output, "mean" for the mean over all the tokens
+  """
+  def __init__(self, patch_size=64, d_model=512, nhead=8, dim_feedforward=2048, dropout=0.1, num_layers=1,
+               in_channels=4, window=4000, pool="cls"):
+    super().__init__()
+    self.patch_size = patch_size
+    self.seq_len = window // patch_size
+    self.pool = pool
+
+    # strided Conv1d patch embedding, the same map as a Linear over the flattened [C, patch_size]
+    # patches (checkpoints with the Linear weight are converted by _load_linear_patch_embedding)
+    self.input_project = nn.Conv1d(in_channels, d_model, kernel_size=patch_size, stride=patch_size)
+    self._register_load_state_dict_pre_hook(self._load_linear_patch_embedding)
+    self.dropout = nn.Dropout(dropout)
+    encoder_layer = SDPAEncoderLayer(d_model=d_model, nhead=nhead, dim_feedforward=dim_feedforward, dropout=dropout,
+                                     activation=nn.GELU(), batch_first=True, norm_first=True)
+    self.transformer_encoder = nn.TransformerEncoder(encoder_layer, num_layers=num_layers)
+    self.mlp_head = nn.Linear(d_model, 2)
+
+    self.cls_token = nn.Parameter(torch.rand(1, 1, d_model))
+    self.pos_embedding = nn.Parameter(torch.randn(1, self.seq_len+1, d_model))
+
+  def _load_linear_patch_embedding(self, state_dict, prefix, *args):
+    # nn.Linear(C*patch_size, d_model) weight [d_model, C*patch_size] -> Conv1d weight [d_model, C, patch_size]
+    key = prefix + "input_project.weight"
+    if key in state_dict and state_dict[key].dim() == 2:
+      state_dict[key] = state_dict[key].reshape(self.input_project.weight.shape)
+
+  def embed(self, x):
+    # convert from raw signals to patch embeddings, the samples after the last full patch are dropped
+    return self.input_project(x).transpose(1, 2)              # [B, seq_len, d_model]
+
+  def encode(self, x):
+    # add class token and positional embedding
+    B = x.shape[0]
+    x = torch.cat((self.cls_token.expand(B, -1, -1), x), dim=1)
+    x = x + self.pos_embedding[:,:(self.seq_len+1)]
+    x = self.dropout(x)
+
+    x = self.transformer_encoder(x)
+
+    # compare to using only the cls_token, using mean of embedding has a much smoother loss curve
+    if self.pool == "mean":
+      return x.mean(dim=1)
+    return x[:,0,:]
+
+  def features(self, x):
+    return self.encode(self.embed(x))
+
+  def forward(self, x):
+    x = self.features(x)
+    x = self.mlp_head(x)
+    return x
+
+  @torch.no_grad()
+  def stream(self, signal, hop, batch_size=256):
+    """
+    Scores every window of a continuous [C, T] recording starting each hop samples. The patch
+    embeddings are computed once for the whole recording and the overlapping windows are
+    batched from them, so hop has to be a multiple of patch_size. Returns the logits [W, 2]
+    and the first sample of each window [W]. The signal has to be normalized like the
+    training windows, the model is expected to be in eval mode.
+    """
+    if hop % self.patch_size:
+      raise ValueError(f"hop ({hop}) has to be a multiple of patch_size ({self.patch_size})")
+    step = hop // self.patch_size
+    z = self.embed(signal[None])[0]                           # [T // patch_size, d_model]
+    if z.shape[0] < self.seq_len:
+      return z.new_empty((0, 2)), torch.empty(0, dtype=torch.long)
+    windows = z.unfold(0, self.seq_len, step).transpose(1, 2) # [W, seq_len, d_model] (a view)
+    logits = torch.cat([self.mlp_head(self.encode(windows[i:i+batch_size]))
+                        for i in range(0, len(windows), batch_size)])
+    return logits, torch.arange(len(windows)) * hop
+
+def benchmark_stream(model, signal, hop, batch_size=256, repeats=3):
+  """
+  Windows/sec of model.stream() against re-embedding every window with forward(), on a
+  [C, T] recording already on the model's device.
+  """
+  model.eval()
+  window = model.seq_len * model.patch_size
+  results = {}
+  with torch.no_grad():
+    starts = range(0, signal.shape[1] - window + 1, hop)
+    def per_window():
+      return torch.cat([model(torch.stack([signal[:, s:s+window] for s in starts[i:i+batch_size]]))
+                        for i in range(0, len(starts), batch_size)])
+    def streamed():
+      return model.stream(signal, hop, batch_size)[0]
+    for name, run in (("per_window", per_window), ("stream", streamed)):
+      run()
+      start = time.perf_counter()
+      for _ in range(repeats):
+        logits = run()
+      if signal.is_cuda:
+        torch.cuda.synchronize()
+      results[name] = repeats * len(logits) / (time.perf_counter() - start)
+      print(f"{name}: {results[name]:.1f} windows/sec ({len(logits)} windows, hop {hop})")
+  return results
+
+if __name__ == "__main__":
+  # from src/: python -m util.sEMGmodels --seconds 60 --hop 64
+  import argparse
+  parser = argparse.ArgumentParser(description="Streaming inference throughput of sEMGtransformer")
+  parser.add_argument("--seconds", type=float, default=60, help="length of the synthetic recording")
+  parser.add_argument("--rate", type=int, default=4000, help="samples per second")
+  parser.add_argument("--hop", type=int, default=64, help="hop between windows in samples")
+  parser.add_argument("--bsz", type=int, default=256, help="windows per batch")
+  parser.add_argument("--device", type=str, default="cpu", help="cuda or cpu")
+  args = parser.parse_args()
+
+  model = sEMGtransformer(patch_size=64, d_model=256, nhead=8, dim_feedforward=1024, num_layers=3).to(args.device)
+  signal = torch.randn(4, int(args.seconds * args.rate), device=args.device)
+  benchmark_stream(model, signal, args.hop, args.bsz)
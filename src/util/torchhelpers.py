@@ -0,0 +1,325 @@
+import os, copy, time, torch, threading
+from torch import nn
+from contextlib import nullcontext
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+# autocast dtypes of the precision modes, "auto" is fp16 on cuda and bf16 on cpu
+PRECISIONS = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+def select_device(device=None):
+  if device:
+    return torch.device(device)
+  return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def set_threads(threads=None, interop_threads=None):
+  # intra-op threads of the BLAS/oneDNN kernels and inter-op threads running independent ops,
+  # the inter-op pool can only be sized before its first use
+  if threads:
+    torch.set_num_threads(threads)
+  if interop_threads:
+    try:
+      torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+      print(f"Inter-op threads already started, keeping {torch.get_num_interop_threads()}")
+
+class Runtime(object):
+  """
+  Device, autocast precision and loss scaling shared by the training scripts, so that the
+  same script runs on a GPU (fp16 autocast with a GradScaler) and on CPU-only nodes
+  (bf16 autocast, which needs no loss scaling).
+  device        : "cuda", "cpu", ... or None for cuda when available
+  precision     : "auto", "fp32", "fp16" or "bf16"
+  channels_last : keep 5D inputs and models in channels_last_3d (for the Conv3d of SFCN)
+  """
+  def __init__(self, device=None, precision="auto", threads=None, interop_threads=None, channels_last=False):
+    self.device = select_device(device)
+    if precision == "auto":
+      precision = "fp16" if self.device.type == "cuda" else "bf16"
+    self.precision = precision
+    self.dtype = PRECISIONS[precision]
+    self.channels_last = channels_last
+    set_threads(threads, interop_threads)
+
+  def autocast(self):
+    if self.precision == "fp32":
+      return nullcontext()
+    return torch.autocast(device_type=self.device.type, dtype=self.dtype)
+
+  def grad_scaler(self):
+    # only fp16 needs loss scaling, the disabled scaler passes the loss and the step through
+    return torch.cuda.amp.GradScaler(enabled=self.device.type == "cuda" and self.precision == "fp16")
+
+  def model(self, model):
+    model = model.to(self.device)
+    if self.channels_last:
+      model = model.to(memory_format=torch.channels_last_3d)
+    return model
+
+  def inputs(self, x):
+    x = x.to(self.device, non_blocking=True)
+    if self.channels_last and x.dim() == 5:
+      x = x.contiguous(memory_format=torch.channels_last_3d)
+    return x
+
+  def synchronize(self):
+    if self.device.type == "cuda":
+      torch.cuda.synchronize(self.device)
+
+  def __repr__(self):
+    return f"Runtime(device={self.device}, precision={self.precision}, threads={torch.get_num_threads()}, channels_last={self.channels_last})"
+
+def compile_model(model, dynamic=False, mode=None):
+  """
+  torch.compile'd forward of model with static shapes (a last smaller batch compiles once
+  more), falling back to the eager model when torch.compile is unavailable or fails to compile
+  it. Any other error of the forward is raised as it is. The compiled forward shares the
+  parameters of model, which stays the one to train, save and copy.
+  """
+  if not hasattr(torch, "compile"):
+    return model
+  # the errors of dynamo and of the compiler backends (BackendCompilerFailed) derive from it
+  from torch._dynamo.exc import TorchDynamoException
+  compiled = torch.compile(model, dynamic=dynamic, mode=mode)
+  failed = []
+  def forward(*args, **kwargs):
+    if not failed:
+      try:
+        return compiled(*args, **kwargs)
+      except TorchDynamoException as e:
+        print(f"torch.compile failed, running eager: {e}")
+        failed.append(e)
+    return model(*args, **kwargs)
+  return forward
+
+def fold_batchnorm(model):
+  # inference copy of model with every Conv followed by a BatchNorm inside a Sequential folded
+  # into the Conv weights, only valid in eval mode
+  model = copy.deepcopy(model).eval()
+  for module in model.modules():
+    if not isinstance(module, nn.Sequential):
+      continue
+    names = list(module._modules)
+    for a, b in zip(names, names[1:]):
+      conv, bn = module._modules[a], module._modules[b]
+      if isinstance(conv, nn.modules.conv._ConvNd) and isinstance(bn, nn.modules.batchnorm._BatchNorm):
+        module._modules[a] = fuse_conv_bn_eval(conv, bn)
+        module._modules[b] = nn.Identity()
+  return model
+
+def _save_atomic(obj, path):
+  tmp = f"{path}.tmp"
+  torch.save(obj, tmp)
+  os.replace(tmp, path)
+
+class ModelSnapshot(object):
+  """
+  Best-so-far copy of the parameters and buffers of a model in tensors preallocated once (on
+  device, the model's by default), which update() overwrites in place instead of deep copying
+  the whole module on every improvement. The tensors start as a copy of the current state, so
+  a run that never improves (e.g. a NaN metric) restores its initial weights rather than
+  uninitialized memory, taken tells the two apart. save_async() writes the snapshot to disk
+  from a background thread. module() rebuilds the final snapshot into a model.
+  """
+  def __init__(self, model, device=None):
+    with torch.no_grad():
+      self.tensors = {k: v.detach().to(device=device, copy=True) for k, v in model.state_dict().items()}
+    self.taken = False
+    self._writer = None
+
+  def update(self, model):
+    # the previous write may still be reading the tensors
+    self.wait()
+    with torch.no_grad():
+      for k, v in model.state_dict().items():
+        self.tensors[k].copy_(v)
+    self.taken = True
+
+  def save_async(self, path, **extra):
+    # {"model": snapshot, **extra} written to path through a temporary file, so that an
+    # interrupted write never leaves a truncated file behind, wait() before the process exits
+    self.wait()
+    self._writer = threading.Thread(target=_save_atomic, args=({"model": self.tensors, **extra}, path), daemon=True)
+    self._writer.start()
+
+  def wait(self):
+    if self._writer is not None:
+      self._writer.join()
+      self._writer = None
+
+  def load_into(self, model):
+    model.load_state_dict(self.tensors)
+    return model
+
+  def module(self, model):
+    # a single copy of model holding the snapshot, model itself keeps its current weights
+    if not self.taken:
+      print("No snapshot was taken, the copy holds the initial weights")
+    return self.load_into(copy.deepcopy(model))
+
+def _throughput(forward, step, x, runtime, steps, warmup):
+  # samples/sec of step(forward) after warmup untimed steps (which include the compilation)
+  for i in range(warmup + steps):
+    if i == warmup:
+      runtime.synchronize()
+      start = time.perf_counter()
+    out = step(forward)
+  runtime.synchronize()
+  return steps * len(x) / (time.perf_counter() - start), out
+
+def _train_step(model, x, y, criterion, runtime):
+  optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+  scaler = runtime.grad_scaler()
+  def step(forward):
+    optimizer.zero_grad()
+    with runtime.autocast():
+      loss = criterion(forward(x), y)
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+    return loss.item()
+  return step
+
+def benchmark_precisions(make_model, inputs, targets, criterion, device=None, precisions=("fp32", "bf16"),
+                         channels_last=False, steps=20, warmup=3):
+  """
+  Training-step throughput (samples/sec) of a fresh model from make_model() for every
+  precision mode on the same device, together with the final loss as a sanity check.
+  """
+  results = {}
+  for precision in precisions:
+    runtime = Runtime(device, precision, channels_last=channels_last)
+    model = runtime.model(make_model()).train()
+    x, y = runtime.inputs(inputs), targets.to(runtime.device)
+    samples_per_sec, loss = _throughput(model, _train_step(model, x, y, criterion, runtime), x, runtime, steps, warmup)
+
+    results[precision] = {"samples_per_sec": samples_per_sec, "loss": loss}
+    print(f"{runtime}: {samples_per_sec:.1f} samples/sec, loss {loss:.4f}")
+  return results
+
+def benchmark_compile(make_model, inputs, targets, criterion, device="cpu", precision="fp32",
+                      channels_last=False, steps=20, warmup=3):
+  """
+  Samples/sec of eager vs compile_model() execution for training steps and for inference
+  (eval mode, with the BatchNorms folded), each on a fresh model from make_model().
+  """
+  runtime = Runtime(device, precision, channels_last=channels_last)
+  x, y = runtime.inputs(inputs), targets.to(runtime.device)
+  results = {}
+  for name, compiled in (("eager", False), ("compiled", True)):
+    model = runtime.model(make_model()).train()
+    forward = compile_model(model) if compiled else model
+    train_sps, _ = _throughput(forward, _train_step(model, x, y, criterion, runtime), x, runtime, steps, warmup)
+
+    model = fold_batchnorm(model)
+    forward = compile_model(model) if compiled else model
+    def infer(forward):
+      with torch.no_grad(), runtime.autocast():
+        return forward(x)
+    infer_sps, _ = _throughput(forward, infer, x, runtime, steps, warmup)
+
+    results[name] = {"train_samples_per_sec": train_sps, "infer_samples_per_sec": infer_sps}
+    print(f"{name} {runtime}: train {train_sps:.1f} samples/sec, inference {infer_sps:.1f} samples/sec")
+  return results
+
+def quantize_dynamic(model):
+  # CPU inference copy of model with the weights of every nn.Linear in int8, the activations
+  # are quantized on the fly per batch
+  model = copy.deepcopy(model).eval().cpu()
+  # the fused inference path of nn.TransformerEncoder(Layer) reads the fp32 weights of the
+  # feed-forward Linears directly, the layers of the copy take the module by module path
+  # (attention projections stay fp32, out_proj is not dynamically quantizable)
+  for module in model.modules():
+    if isinstance(module, nn.TransformerEncoderLayer):
+      module.activation_relu_or_gelu = 0
+  return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def quantize_static(model, calibration, module_types=(nn.Conv3d,), backend="fbgemm"):
+  """
+  CPU inference copy of model with the modules of module_types statically quantized to int8
+  (FX graph mode), after folding the BatchNorms. The activation ranges are observed on the
+  input batches of calibration, everything else keeps running in fp32.
+  """
+  from torch.ao.quantization import QConfigMapping, get_default_qconfig
+  from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+  torch.backends.quantized.engine = backend
+  model = fold_batchnorm(model).cpu().to(memory_format=torch.contiguous_format)
+  qconfig_mapping = QConfigMapping()
+  for module_type in module_types:
+    qconfig_mapping.set_object_type(module_type, get_default_qconfig(backend))
+
+  calibration = [x.cpu().contiguous() for x in calibration]
+  prepared = prepare_fx(model, qconfig_mapping, example_inputs=(calibration[0],))
+  with torch.no_grad():
+    for x in calibration:
+      prepared(x)
+  return convert_fx(prepared)
+
+def parity_report(reference, quantized, batches, metric):
+  """
+  metric(outputs, targets) -> sum over the batch (e.g. correct predictions or absolute age
+  errors), averaged over all the samples for the reference and the quantized model, plus the
+  largest output difference between the two. Both models are run on CPU in eval mode.
+  """
+  reference = copy.deepcopy(reference).eval().cpu()
+  total = {"reference": 0.0, "quantized": 0.0}
+  count, max_diff = 0, 0.0
+  with torch.no_grad():
+    for x, y in batches:
+      x, y = x.cpu().contiguous(), y.cpu()
+      out_ref, out_q = reference(x), quantized(x)
+      total["reference"] += float(metric(out_ref, y))
+      total["quantized"] += float(metric(out_q, y))
+      max_diff = max(max_diff, float((out_ref - out_q).abs().max()))
+      count += len(x)
+  report = {name: value / count for name, value in total.items()}
+  report["max_abs_diff"] = max_diff
+  return report
+
+def benchmark_inference(models, x, steps=20, warmup=3):
+  # batch inference samples/sec of every {name: model} on the same CPU batch
+  runtime = Runtime("cpu", "fp32")
+  x = x.cpu().contiguous()
+  results = {}
+  for name, model in models.items():
+    def infer(forward):
+      with torch.no_grad():
+        return forward(x)
+    results[name], _ = _throughput(model, infer, x, runtime, steps, warmup)
+    print(f"{name}: {results[name]:.1f} samples/sec (batch {len(x)}, {torch.get_num_threads()} threads)")
+  return results
+
+if __name__ == "__main__":
+  # from src/: python -m util.torchhelpers --model sfcn --device cpu --precisions fp32 bf16
+  #             python -m util.torchhelpers --model transformer --device cpu --compile
+  import argparse
+  parser = argparse.ArgumentParser(description="Throughput of the precision modes or of eager vs compiled execution")
+  parser.add_argument("--model", type=str, default="transformer", choices=["transformer", "sfcn"], help="model to benchmark")
+  parser.add_argument("--compile", action="store_true", help="compare eager and compiled execution (in the first of --precisions)")
+  parser.add_argument("--device", type=str, default=None, help="cuda or cpu, cuda when available by default")
+  parser.add_argument("--precisions", nargs="+", default=["fp32", "bf16"], help="precision modes to compare")
+  parser.add_argument("--bsz", type=int, default=8, help="batch size")
+  parser.add_argument("--steps", type=int, default=20, help="number of timed training steps")
+  parser.add_argument("--threads", type=int, default=0, help="intra-op threads, 0 for the torch default")
+  args = parser.parse_args()
+  set_threads(args.threads)
+
+  if args.model == "transformer":
+    from util.sEMGmodels import sEMGtransformer
+    make_model = lambda: sEMGtransformer(patch_size=64, d_model=256, nhead=8, dim_feedforward=1024, num_layers=3)
+    inputs = torch.randn(args.bsz, 4, 4000)
+    targets = nn.functional.one_hot(torch.randint(0, 2, (args.bsz,)), 2).float()
+    criterion, channels_last = nn.CrossEntropyLoss(), False
+  else:
+    from fMRI_convnet import SFCN
+    make_model = lambda: SFCN(output_dim=64)
+    inputs = torch.randn(args.bsz, 1, 64, 64, 64)
+    targets = torch.softmax(torch.randn(args.bsz, 64), dim=1)
+    kl_div = nn.KLDivLoss(reduction="batchmean", log_target=True)
+    criterion, channels_last = (lambda output, y: kl_div(output.log(), y.log())), True
+
+  if args.compile:
+    benchmark_compile(make_model, inputs, targets, criterion, args.device or "cpu", args.precisions[0],
+                      channels_last=channels_last, steps=args.steps)
+  else:
+    benchmark_precisions(make_model, inputs, targets, criterion, args.device, args.precisions,
+                         channels_last=channels_last, steps=args.steps)
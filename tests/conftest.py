@@ -0,0 +1,4 @@
+import os, sys
+
+# the scripts import their helpers relative to src
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
@@ -0,0 +1,27 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from torch import nn
+from util.torchhelpers import compile_model
+
+class CheckedDouble(nn.Module):
+  def __init__(self):
+    super().__init__()
+    self.rejected = []
+
+  def forward(self, x):
+    if x.shape[0] > 2:
+      self.rejected.append(x.shape[0])
+      raise ValueError("batch too large")
+    return x * 2
+
+def test_compile_model_raises_forward_errors():
+  model = CheckedDouble()
+  forward = compile_model(model)
+  assert torch.equal(forward(torch.ones(2)), torch.full((2,), 2.0))
+  # an error of the model itself is raised as it is, not taken for a compiler failure and
+  # run again eagerly
+  with pytest.raises(ValueError, match="batch too large"):
+    forward(torch.ones(3))
+  assert model.rejected == [3]
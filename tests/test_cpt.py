@@ -0,0 +1,13 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("mlconfound")
+
+from mlconfound.simulate import simulate_y_c_yhat
+from cpt import verify_multi, multi_examples
+
+@pytest.mark.parametrize("name, cat_yhat", [("binary", True), ("3-class", True), ("continuous", False)])
+def test_cpt_p_multi_matches_partial_confound_test(name, cat_yhat):
+  H1_y, H1_c, H1_yhat = simulate_y_c_yhat(w_yc=0.5, w_yyhat=0.5, w_cyhat=0.1, n=300, random_state=42)
+  Y_cat, Yhats = multi_examples(H1_y, H1_yhat)
+  verify_multi(num_perm=30, random_state=5, H1_y=Y_cat, H1_c=H1_c, H1_yhats=Yhats[name], cat_yhat=cat_yhat)
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("pymoo")
+pytest.importorskip("threadpoolctl")
+
+from pymoo.optimize import minimize
+from pymoo.algorithms.moo.nsga2 import NSGA2
+from pymoo.core.problem import ElementwiseProblem
+from pymoo.core.callback import Callback
+from util.GAhelpers import FidelitySchedule, ProxyScreen, refine_front, save_checkpoint, \
+                          load_checkpoint, resume_algorithm
+
+NGEN   = 6
+CONFIG = {"pop": 12, "ngen": NGEN, "perm": 40, "perm_min": 5}
+
+class Interrupted(Exception):
+  pass
+
+class ToyProblem(ElementwiseProblem):
+  # the objectives of the GA scripts, with a cheap stand-in for the CPT
+  def __init__(self, fidelity, screen):
+    super().__init__(n_var=4, n_obj=2, xl=-np.ones(4), xu=np.ones(4))
+    self.fidelity = fidelity
+    self.screen = screen
+    self.cache = {}
+    self.generation = 1
+
+  def confounding_proxy(self, x):
+    return float(np.abs(x).sum())
+
+  def objectives(self, x, num_perms=None):
+    screening = num_perms is None
+    if num_perms is None:
+      num_perms = self.fidelity.num_perms(self.generation)
+    key = x.tobytes()
+    if key in self.cache and self.cache[key][1] >= num_perms:
+      return self.cache[key][0]
+
+    f1 = float((x**2).sum())
+    f2 = self.screen.screen(f1, self.confounding_proxy(x)) if screening else None
+    if f2 is None:
+      f2 = float(((x - 0.5)**2).sum()) + 1.0/num_perms
+      self.fidelity.spend(num_perms)
+      if screening:
+        self.screen.record(f1, self.confounding_proxy(x), f2)
+    self.cache[key] = ([f1, f2], num_perms)
+    return [f1, f2]
+
+  def _evaluate(self, x, out, *args, **kwargs):
+    out["F"] = self.objectives(x)
+
+class ToyCallback(Callback):
+  def __init__(self, problem, ckpt_path, stop=None):
+    super().__init__()
+    self.data["best"] = []
+    self.data["n_gen"] = []
+    self.problem = problem
+    self.ckpt_path = ckpt_path
+    self.stop = stop
+
+  def notify(self, algorithm):
+    refine_front(algorithm, self.problem, self.problem.fidelity.num_perms(algorithm.n_gen))
+    self.problem.generation = algorithm.n_gen + 1
+    X, F = algorithm.opt.get("X"), algorithm.opt.get("F")
+    self.problem.screen.update(F, [self.problem.confounding_proxy(x) for x in X])
+    self.data["best"].append(algorithm.pop.get("F")[:,0].min())
+    self.data["n_gen"].append(algorithm.n_gen)
+    save_checkpoint(self.ckpt_path, algorithm, cache=self.problem.cache, callback_data=self.data,
+                    config=CONFIG, fidelity=self.problem.fidelity, screen=self.problem.screen)
+    if algorithm.n_gen == self.stop:
+      raise Interrupted()
+
+def run(ckpt_path, stop=None, resume=False):
+  # the GA block of the scripts
+  np.random.seed(0)
+  fidelity = FidelitySchedule(CONFIG["perm_min"], CONFIG["perm"], NGEN)
+  screen = ProxyScreen(audit=0.3, random_state=0)
+  problem = ToyProblem(fidelity, screen)
+  algorithm = NSGA2(pop_size=CONFIG["pop"])
+  callback = ToyCallback(problem, ckpt_path, stop)
+
+  checkpoint = load_checkpoint(ckpt_path, CONFIG) if resume else None
+  if checkpoint is not None:
+    problem.cache.update(checkpoint["cache"])
+    problem.generation = checkpoint["n_gen"] + 1
+    fidelity.load_state_dict(checkpoint["fidelity"])
+    screen.load_state_dict(checkpoint["screen"])
+    callback.data.update(checkpoint["callback"])
+    algorithm = resume_algorithm(checkpoint, problem, ("n_gen", NGEN), callback=callback, seed=1)
+
+  res = minimize(problem, algorithm, ("n_gen", NGEN), copy_algorithm=False, callback=callback, seed=1)
+  return res, callback, problem
+
+def test_resume_matches_uninterrupted_run(tmp_path):
+  full, full_callback, full_problem = run(str(tmp_path / "full.pkl"))
+
+  path = str(tmp_path / "interrupted.pkl")
+  with pytest.raises(Interrupted):
+    run(path, stop=3)
+  assert load_checkpoint(path)["n_gen"] == 3
+  res, callback, problem = run(path, resume=True)
+
+  assert res.algorithm.n_gen == full.algorithm.n_gen
+  assert res.algorithm.evaluator.n_eval == full.algorithm.evaluator.n_eval
+  assert callback.data["n_gen"] == full_callback.data["n_gen"] == list(range(1, NGEN + 1))
+  assert callback.data["best"] == full_callback.data["best"]
+  np.testing.assert_array_equal(res.F, full.F)
+  assert problem.fidelity.used == full_problem.fidelity.used
+  assert (problem.screen.agree, problem.screen.checked, problem.screen.skipped) == \
+         (full_problem.screen.agree, full_problem.screen.checked, full_problem.screen.skipped)
+
+def test_resume_refuses_other_config(tmp_path):
+  path = str(tmp_path / "ga.pkl")
+  with pytest.raises(Interrupted):
+    run(path, stop=1)
+  with pytest.raises(ValueError, match="pop"):
+    load_checkpoint(path, {**CONFIG, "pop": 24})
@@ -0,0 +1,21 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from util.sEMGmodels import sEMGtransformer
+from util.torchhelpers import quantize_dynamic
+
+def test_quantize_dynamic_transformer():
+  torch.manual_seed(0)
+  model = sEMGtransformer(patch_size=16, d_model=32, nhead=4, dim_feedforward=64, num_layers=2,
+                          window=128).eval()
+  x = torch.randn(3, 4, 128)
+
+  model_int8 = quantize_dynamic(model)
+  with torch.no_grad():
+    expected = model(x)
+    outputs  = model_int8(x)
+
+  assert isinstance(model_int8.transformer_encoder.layers[0].linear1, torch.ao.nn.quantized.dynamic.Linear)
+  assert outputs.shape == (3, 2)
+  assert torch.allclose(outputs, expected, atol=0.1)
@@ -0,0 +1,28 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from torch import nn
+from util.torchhelpers import ModelSnapshot
+
+def test_snapshot_keeps_the_best_weights(tmp_path):
+  model = nn.Linear(4, 2)
+  initial = {k: v.clone() for k, v in model.state_dict().items()}
+  snapshot = ModelSnapshot(model)
+  assert torch.equal(snapshot.module(model).weight, initial["weight"])
+
+  with torch.no_grad():
+    model.weight.add_(1)
+  snapshot.update(model)
+  best = model.weight.clone()
+  with torch.no_grad():
+    model.weight.add_(1)
+
+  path = str(tmp_path / "best.pth")
+  snapshot.save_async(path, accuracy=0.5)
+  snapshot.wait()
+  saved = torch.load(path)
+  assert saved["accuracy"] == 0.5
+  assert torch.equal(saved["model"]["weight"], best)
+  assert torch.equal(snapshot.module(model).weight, best)
+  assert torch.equal(model.weight, best + 1)